@@ -0,0 +1,200 @@
+# ~*~ coding: utf-8 ~*~
+#-
+# OSMAlchemy - OpenStreetMap to SQLAlchemy bridge
+# Copyright (c) 2016 Dominik George <nik@naturalnet.de>
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+#
+# Alternatively, you are free to use OSMAlchemy under Simplified BSD, The
+# MirOS Licence, GPL-2+, LGPL-2.1+, AGPL-3+ or the same terms as Python
+# itself.
+
+
+""" Run OSMAlchemy benchmarks on SQLite and emit the results as JSON.
+
+Usage: python -m benchmarks.run [--size small|medium|large] [--output FILE]
+"""
+
+import argparse
+import io
+import json
+import os
+import platform
+import random
+import shutil
+import sys
+import tempfile
+import time
+
+import sqlalchemy
+from sqlalchemy import create_engine
+from sqlalchemy.ext.declarative import declarative_base
+from sqlalchemy.orm import sessionmaker, scoped_session
+
+from osmalchemy import OSMAlchemy
+
+from .synthetic import generate_osm
+
+# Parameters of the synthetic data for each size
+SIZES = {"small": {"nodes": 10000, "ways": 1000, "relations": 50},
+         "medium": {"nodes": 100000, "ways": 10000, "relations": 500},
+         "large": {"nodes": 1000000, "ways": 100000, "relations": 5000}}
+
+# Number of operations for the query benchmarks
+OPERATIONS = 200
+
+# Most precise clock available
+_clock = getattr(time, "perf_counter", time.time)
+
+def _model(path):
+    """ Create an OSMAlchemy model in a new SQLite database file. """
+
+    engine = create_engine("sqlite:///" + path)
+    base = declarative_base(bind=engine)
+    session = scoped_session(sessionmaker(bind=engine))
+    osmalchemy = OSMAlchemy((engine, base, session))
+    base.metadata.create_all()
+    return osmalchemy, session
+
+def _measure(results, name, operations, fn):
+    """ Run fn once and store its timing under name. """
+
+    start = _clock()
+    fn()
+    seconds = _clock() - start
+
+    results[name] = {"seconds": seconds, "operations": operations,
+                     "per_second": operations / seconds if seconds else None}
+
+def run(size="small", seed=42, workdir=None):
+    """ Run all benchmarks and return the results as a dictionary.
+
+      size - name of the data size, one of the keys of SIZES
+      seed - seed for data generation and random lookups
+      workdir - directory for data and database files, a temporary one by default
+    """
+
+    params = dict(SIZES[size], seed=seed)
+    rng = random.Random(seed)
+    results = {}
+
+    tmpdir = workdir or tempfile.mkdtemp(prefix="osmalchemy-bench-")
+    try:
+        # Generate data file
+        datafile = os.path.join(tmpdir, "synthetic.osm")
+        with io.open(datafile, "w", encoding="utf-8") as out:
+            generate_osm(out, **params)
+
+        # Import using the ORM and using Core
+        osmalchemy, session = _model(os.path.join(tmpdir, "orm.db"))
+        _measure(results, "import_osm_file", params["nodes"] + params["ways"] +
+                 params["relations"], lambda: osmalchemy.import_osm_file(datafile))
+        session.remove()
+        osmalchemy, session = _model(os.path.join(tmpdir, "bulk.db"))
+        _measure(results, "import_osm_file_bulk", params["nodes"] + params["ways"] +
+                 params["relations"], lambda: osmalchemy.import_osm_file(datafile, bulk=True))
+        session.remove()
+
+        # Random samples of elements to query
+        node_ids = [rng.randint(1, params["nodes"]) for i in range(OPERATIONS)]
+        way_ids = [rng.randint(1, params["ways"]) for i in range(OPERATIONS)]
+        relation_ids = [rng.randint(1, params["relations"]) for i in range(OPERATIONS)]
+
+        def _id_lookups():
+            for id in node_ids:
+                session.query(osmalchemy.node).filter_by(id=id).one()
+            session.remove()
+        _measure(results, "id_lookup", OPERATIONS, _id_lookups)
+
+        def _tag_queries():
+            for i in range(OPERATIONS):
+                session.query(osmalchemy.way).join(
+                    osmalchemy.elements_tags,
+                    osmalchemy.elements_tags.element_id == osmalchemy.way.element_id).join(
+                        osmalchemy.tag).filter(osmalchemy.tag.key == u"highway",
+                                               osmalchemy.tag.value == u"residential").count()
+            session.remove()
+        _measure(results, "tag_query", OPERATIONS, _tag_queries)
+
+        def _way_geometries(*options):
+            ways = session.query(osmalchemy.way).filter(
+                osmalchemy.way.id.in_(set(way_ids))).options(*options).all()
+            for way in ways:
+                [(node.latitude, node.longitude) for node in way.nodes]
+            session.remove()
+        _measure(results, "way_geometry", len(set(way_ids)), _way_geometries)
+        _measure(results, "way_geometry_eager", len(set(way_ids)),
+                 lambda: _way_geometries(osmalchemy.with_geometry()))
+        _measure(results, "way_geometry_batched", len(set(way_ids)),
+                 lambda: osmalchemy.load_way_geometries(way_ids))
+
+        def _relation_traversal():
+            relations = session.query(osmalchemy.relation).filter(
+                osmalchemy.relation.id.in_(set(relation_ids))).all()
+            for relation in relations:
+                dict(relation.tags)
+                [(element.id, role) for element, role in relation.members]
+            session.remove()
+        _measure(results, "relation_traversal", len(set(relation_ids)), _relation_traversal)
+
+        def _relation_resolution():
+            for id in set(relation_ids):
+                osmalchemy.resolve_relation(id)
+            session.remove()
+        _measure(results, "relation_resolve", len(set(relation_ids)), _relation_resolution)
+
+        def _bbox_queries():
+            for i in range(OPERATIONS):
+                south, west = rng.uniform(50.70, 50.79), rng.uniform(7.05, 7.19)
+                osmalchemy.query_bbox(south, west, south + 0.01, west + 0.01)
+            session.remove()
+        _measure(results, "query_bbox", OPERATIONS, _bbox_queries)
+    finally:
+        if workdir is None:
+            shutil.rmtree(tmpdir)
+
+    return {"environment": {"python": platform.python_version(),
+                            "sqlalchemy": sqlalchemy.__version__,
+                            "platform": platform.platform()},
+            "size": size,
+            "parameters": params,
+            "results": results}
+
+def main(argv=None):
+    """ Command line entry point. """
+
+    parser = argparse.ArgumentParser(description="Run OSMAlchemy benchmarks")
+    parser.add_argument("--size", choices=sorted(SIZES), default="small",
+                        help="size of the synthetic data")
+    parser.add_argument("--seed", type=int, default=42, help="random seed")
+    parser.add_argument("--workdir", help="directory to keep data and databases in")
+    parser.add_argument("--output", help="file to write JSON results to, default stdout")
+    args = parser.parse_args(argv)
+
+    results = run(args.size, args.seed, args.workdir)
+
+    data = json.dumps(results, indent=2, sort_keys=True)
+    if args.output:
+        with open(args.output, "w") as out:
+            out.write(data + "\n")
+    else:
+        sys.stdout.write(data + "\n")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,128 @@
+# ~*~ coding: utf-8 ~*~
+#-
+# OSMAlchemy - OpenStreetMap to SQLAlchemy bridge
+# Copyright (c) 2016 Dominik George <nik@naturalnet.de>
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+#
+# Alternatively, you are free to use OSMAlchemy under Simplified BSD, The
+# MirOS Licence, GPL-2+, LGPL-2.1+, AGPL-3+ or the same terms as Python
+# itself.
+
+
+""" Deterministic generator of synthetic OSM XML data for benchmarks.
+
+The data resembles a small town: nodes scattered in a bounding box,
+ways made of consecutive runs of nodes, and relations grouping ways,
+nodes and other relations. The same parameters always produce the
+same document.
+"""
+
+import random
+from xml.sax.saxutils import quoteattr
+
+# Keys and values to draw tags from, few distinct pairs like in real data
+_TAG_KEYS = ("highway", "building", "name", "amenity", "surface", "source", "landuse",
+             "addr:street", "addr:housenumber", "oneway")
+_TAG_VALUES = ("residential", "yes", "no", "asphalt", "bing", "service", "house",
+               "footway", "parking", "grass")
+
+# Bounding box of the generated data
+_SOUTH, _WEST, _NORTH, _EAST = 50.70, 7.05, 50.80, 7.20
+
+def _tags(rng, count):
+    """ Get count random tags as a dictionary. """
+
+    tags = {}
+    while len(tags) < count:
+        key = rng.choice(_TAG_KEYS)
+        if key == "name":
+            # Names are mostly unique
+            tags[key] = u"Name %d" % rng.randint(0, 100000)
+        else:
+            tags[key] = rng.choice(_TAG_VALUES)
+    return tags
+
+def _write_tags(out, tags):
+    for key, value in sorted(tags.items()):
+        out.write(u'  <tag k=%s v=%s/>\n' % (quoteattr(key), quoteattr(value)))
+
+def generate_osm(out, nodes=10000, ways=1000, relations=50, tags=2, way_nodes=10,
+                 members=10, seed=42):
+    """ Write a synthetic OSM XML document.
+
+      out - text file object to write to
+      nodes - number of nodes
+      ways - number of ways
+      relations - number of relations
+      tags - average number of tags per element
+      way_nodes - average number of nodes per way
+      members - average number of members per relation
+      seed - seed for the random number generator
+    """
+
+    rng = random.Random(seed)
+    meta = u'version="1" changeset="1" user="bench" uid="1" visible="true" ' \
+           u'timestamp="2016-01-01T00:00:00Z"'
+
+    out.write(u'<?xml version="1.0" encoding="UTF-8"?>\n')
+    out.write(u'<osm version="0.6" generator="OSMAlchemy benchmarks">\n')
+    out.write(u' <bounds minlat="%.7f" minlon="%.7f" maxlat="%.7f" maxlon="%.7f"/>\n' %
+              (_SOUTH, _WEST, _NORTH, _EAST))
+
+    # Nodes, only some of them tagged
+    for id in range(1, nodes + 1):
+        out.write(u' <node id="%d" lat="%.7f" lon="%.7f" %s' %
+                  (id, rng.uniform(_SOUTH, _NORTH), rng.uniform(_WEST, _EAST), meta))
+        count = rng.randint(0, 2 * tags) if rng.random() < 0.2 else 0
+        if count:
+            out.write(u'>\n')
+            _write_tags(out, _tags(rng, count))
+            out.write(u' </node>\n')
+        else:
+            out.write(u'/>\n')
+
+    # Ways, made of consecutive runs of nodes
+    for id in range(1, ways + 1):
+        out.write(u' <way id="%d" %s>\n' % (id, meta))
+        length = max(2, rng.randint(way_nodes // 2, way_nodes * 3 // 2))
+        start = rng.randint(1, max(1, nodes - length))
+        for ref in range(start, min(nodes, start + length - 1) + 1):
+            out.write(u'  <nd ref="%d"/>\n' % ref)
+        _write_tags(out, _tags(rng, rng.randint(1, 2 * tags) if tags else 0))
+        out.write(u' </way>\n')
+
+    # Relations, mostly ways, some nodes and some other relations
+    for id in range(1, relations + 1):
+        out.write(u' <relation id="%d" %s>\n' % (id, meta))
+        for i in range(max(1, rng.randint(members // 2, members * 3 // 2))):
+            kind = rng.random()
+            if kind < 0.8 or relations == 1:
+                out.write(u'  <member type="way" ref="%d" role="outer"/>\n' %
+                          rng.randint(1, ways))
+            elif kind < 0.95:
+                out.write(u'  <member type="node" ref="%d" role="stop"/>\n' %
+                          rng.randint(1, nodes))
+            else:
+                out.write(u'  <member type="relation" ref="%d" role=""/>\n' %
+                          rng.randint(1, relations))
+        _write_tags(out, {u"type": u"route", u"ref": u"%d" % id})
+        out.write(u' </relation>\n')
+
+    out.write(u'</osm>\n')
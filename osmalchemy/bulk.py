@@ -0,0 +1,346 @@
+# ~*~ coding: utf-8 ~*~
+#-
+# OSMAlchemy - OpenStreetMap to SQLAlchemy bridge
+# Copyright (c) 2016 Dominik George <nik@naturalnet.de>
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+#
+# Alternatively, you are free to use OSMAlchemy under Simplified BSD, The
+# MirOS Licence, GPL-2+, LGPL-2.1+, AGPL-3+ or the same terms as Python
+# itself.
+
+
+""" Bulk import of OSM data into an OSMAlchemy model.
+
+The bulk importer writes directly to the tables of the model using
+SQLAlchemy Core, without creating any ORM objects. Element ids are
+assigned by the importer, so it must not run concurrently with other
+writers to the same tables.
+"""
+
+from collections import OrderedDict
+from contextlib import contextmanager
+from io import BytesIO
+from sqlalchemy import bindparam, func, inspect, select
+from sqlalchemy.orm.exc import NoResultFound
+
+from .util import (_IdMap, _LRUCache, _batches, _chunks, _intern_tags, _iterparse_osm, _tile,
+                   _update_bounds, _xml_attrs, _xml_tags)
+
+# Metadata columns of elements, all set on every bulk insert or update
+_ATTRS = ("version", "changeset", "user", "uid", "visible", "timestamp")
+
+@contextmanager
+def _deferred_indexes(osma, session):
+    """ Drop the non-unique indexes of the model and create them again afterwards.
+
+    Loading large amounts of data is faster without maintaining indexes
+    for every row. Unique constraints are kept because the importers
+    rely on them. On MySQL, indexes starting with a foreign key column
+    are kept as well, because InnoDB refuses to drop them.
+
+      osma - reference to the OSMAlchemy model instance
+      session - an SQLAlchemy session
+    """
+
+    tables = [cls.__table__ for cls in (osma.element, osma.node, osma.way, osma.relation,
+                                        osma.tag, osma.elements_tags, osma.ways_nodes,
+                                        osma.relations_elements)]
+
+    # Find indexes that can be dropped
+    conn = session.connection()
+    indexes = []
+    for table in tables:
+        for index in table.indexes:
+            if conn.dialect.name == "mysql" and next(iter(index.columns)).foreign_keys:
+                continue
+            indexes.append(index)
+
+    # Drop indexes that exist in the database
+    inspector = inspect(conn)
+    existing = {}
+    for index in indexes:
+        if index.table.name not in existing:
+            existing[index.table.name] = set(
+                found["name"] for found in inspector.get_indexes(index.table.name))
+        if index.name in existing[index.table.name]:
+            index.drop(bind=conn)
+    session.commit()
+
+    try:
+        yield
+    finally:
+        # Create all indexes again, also after failed imports
+        session.rollback()
+        conn = session.connection()
+        for index in indexes:
+            index.create(bind=conn)
+        session.commit()
+
+class _BulkImporter(object):
+    """ Imports OSM XML elements in chunks using executemany.
+
+    Not used directly; used by _bulk_import_osm_file and _bulk_import_osm_xml.
+    """
+
+    def __init__(self, osma, session):
+        self.session = session
+
+        # Tables of the model
+        self.elements = osma.element.__table__
+        self.tables = {"node": osma.node.__table__,
+                       "way": osma.way.__table__,
+                       "relation": osma.relation.__table__}
+        self.tags = osma.tag.__table__
+        self.elements_tags = osma.elements_tags.__table__
+        self.ways_nodes = osma.ways_nodes.__table__
+        self.relations_elements = osma.relations_elements.__table__
+
+        # Map of OSM ids to element_ids of all elements known to the import
+        self.ids = _IdMap(self.elements)
+
+        # Whether tags are also stored as JSON
+        self.json_tags = "tags_json" in self.elements.c
+
+        # Tables needed for maintaining bounding boxes
+        self.bounds_tables = dict(self.tables, ways_nodes=self.ways_nodes,
+                                  relations_elements=self.relations_elements)
+
+        # Cache of (key, value) to tag_id
+        self.tag_ids = _LRUCache()
+
+        # Next free primary key, determined on first use
+        self.next_element_id = None
+
+    def _next_id(self, conn, column):
+        """ Get the next free value of an integer primary key column. """
+
+        return (conn.execute(select([func.max(column)])).scalar() or 0) + 1
+
+    def _reset_sequence(self, conn, column):
+        """ Move the sequence of a primary key column past pre-assigned values.
+
+        Only needed on PostgreSQL, where explicitly inserted values do not
+        advance the sequence.
+        """
+
+        if conn.dialect.name == "postgresql":
+            seq = func.pg_get_serial_sequence(column.table.name, column.name)
+            conn.execute(select([func.setval(seq, select([func.max(column)]).as_scalar())]))
+
+    def _parse(self, e):
+        """ Convert an OSM XML element to a plain record. """
+
+        record = {"type": e.tag, "id": int(e.attrib["id"]), "tags": _xml_tags(e)}
+
+        # Metadata with all keys present, as required by executemany
+        attrs = _xml_attrs(e)
+        record["attrs"] = dict((name, attrs.get(name, None)) for name in _ATTRS)
+        if self.json_tags:
+            record["attrs"]["tags_json"] = record["tags"]
+
+        # Type-specific data
+        if e.tag == "node":
+            record["latitude"] = float(e.attrib["lat"])
+            record["longitude"] = float(e.attrib["lon"])
+        elif e.tag == "way":
+            record["nodes"] = [int(n.attrib["ref"]) for n in e.iter("nd")]
+        elif e.tag == "relation":
+            record["members"] = [(m.attrib["type"], int(m.attrib["ref"]), m.attrib.get("role", ""))
+                                 for m in e.iter("member")]
+
+        return record
+
+    def import_chunk(self, records):
+        """ Import a list of records and commit. """
+
+        conn = self.session.connection()
+
+        # Initialise primary key counter
+        if self.next_element_id is None:
+            self.next_element_id = self._next_id(conn, self.elements.c.element_id)
+
+        # Drop duplicates, the last occurence of an element wins
+        records = list(OrderedDict(((r["type"], r["id"]), r) for r in records).values())
+
+        # Resolve all elements of the chunk and their references at once
+        keys = set((r["type"], r["id"]) for r in records)
+        for r in records:
+            if r["type"] == "way":
+                keys.update(("node", ref) for ref in r["nodes"])
+            elif r["type"] == "relation":
+                keys.update((type, ref) for type, ref, role in r["members"])
+        self.ids.prefetch(conn, keys)
+
+        # Rows to write
+        new_elements = []
+        new_subrows = {"node": [], "way": [], "relation": []}
+        updated_elements = []
+        updated_nodes = []
+        existing_ids = []
+        elements_tags = []
+        ways_nodes = []
+        relations_elements = []
+
+        def _new_element(type, id, attrs, **subrow):
+            # Pre-assign element_id and remember it
+            element_id = self.next_element_id
+            self.next_element_id += 1
+            self.ids.add(type, id, element_id)
+
+            # Queue rows for element table and table of the type
+            row = dict(attrs)
+            row.update({"element_id": element_id, "type": type, "id": id})
+            new_elements.append(row)
+            subrow["element_id"] = element_id
+            new_subrows[type].append(subrow)
+            return element_id
+
+        # First pass: assign element_ids to all elements of the chunk
+        for r in records:
+            element_id = self.ids.get(r["type"], r["id"])
+            if element_id is None:
+                if r["type"] == "node":
+                    element_id = _new_element("node", r["id"], r["attrs"],
+                                              latitude=r["latitude"], longitude=r["longitude"],
+                                              tile=_tile(r["latitude"], r["longitude"]))
+                else:
+                    element_id = _new_element(r["type"], r["id"], r["attrs"])
+            else:
+                # Update existing element and replace all its mappings
+                row = dict(r["attrs"])
+                row["b_element_id"] = element_id
+                updated_elements.append(row)
+                if r["type"] == "node":
+                    updated_nodes.append({"b_element_id": element_id,
+                                          "latitude": r["latitude"],
+                                          "longitude": r["longitude"],
+                                          "tile": _tile(r["latitude"], r["longitude"])})
+                existing_ids.append(element_id)
+            r["element_id"] = element_id
+
+        # Get or create all tags of the chunk
+        tag_ids = _intern_tags(conn, self.tags,
+                               [pair for r in records for pair in r["tags"].items()],
+                               self.tag_ids)
+
+        # Second pass: tags and references
+        stub_attrs = dict((name, None) for name in _ATTRS)
+        if self.json_tags:
+            stub_attrs["tags_json"] = {}
+        for r in records:
+            for pair in r["tags"].items():
+                elements_tags.append({"element_id": r["element_id"], "tag_id": tag_ids[pair]})
+
+            if r["type"] == "way":
+                for position, ref in enumerate(r["nodes"]):
+                    node_id = self.ids.get("node", ref)
+                    if node_id is None:
+                        raise NoResultFound("Node %d referenced by way %d not found." %
+                                            (ref, r["id"]))
+                    ways_nodes.append({"way_id": r["element_id"], "node_id": node_id,
+                                       "position": position})
+            elif r["type"] == "relation":
+                for position, (type, ref, role) in enumerate(r["members"]):
+                    element_id = self.ids.get(type, ref)
+                    if element_id is None:
+                        # We do not know the member yet, create a stub
+                        if type == "node":
+                            element_id = _new_element(type, ref, stub_attrs,
+                                                      latitude=None, longitude=None, tile=None)
+                        else:
+                            element_id = _new_element(type, ref, stub_attrs)
+                    relations_elements.append({"relation_id": r["element_id"],
+                                               "element_id": element_id,
+                                               "role": role, "position": position})
+
+        # Update existing elements and remove their old mappings
+        if updated_elements:
+            conn.execute(self.elements.update().where(
+                self.elements.c.element_id == bindparam("b_element_id")), updated_elements)
+        if updated_nodes:
+            node_table = self.tables["node"]
+            conn.execute(node_table.update().where(
+                node_table.c.element_id == bindparam("b_element_id")), updated_nodes)
+        for chunk in _chunks(existing_ids):
+            conn.execute(self.elements_tags.delete().where(
+                self.elements_tags.c.element_id.in_(chunk)))
+            conn.execute(self.ways_nodes.delete().where(
+                self.ways_nodes.c.way_id.in_(chunk)))
+            conn.execute(self.relations_elements.delete().where(
+                self.relations_elements.c.relation_id.in_(chunk)))
+
+        # Insert new elements, parent table first
+        if new_elements:
+            conn.execute(self.elements.insert(), new_elements)
+        for type, rows in new_subrows.items():
+            if rows:
+                conn.execute(self.tables[type].insert(), rows)
+
+        # Insert mappings
+        if elements_tags:
+            conn.execute(self.elements_tags.insert(), elements_tags)
+        if ways_nodes:
+            conn.execute(self.ways_nodes.insert(), ways_nodes)
+        if relations_elements:
+            conn.execute(self.relations_elements.insert(), relations_elements)
+
+        # Update bounding boxes of ways and relations of the chunk, and those
+        # using nodes that were moved
+        _update_bounds(conn, self.bounds_tables,
+                       node_ids=[row["b_element_id"] for row in updated_nodes],
+                       way_ids=[r["element_id"] for r in records if r["type"] == "way"],
+                       relation_ids=[r["element_id"] for r in records if r["type"] == "relation"])
+
+        # Keep sequence in sync with pre-assigned primary keys
+        self._reset_sequence(conn, self.elements.c.element_id)
+
+        self.session.commit()
+
+    def run(self, elements, batch_size=10000):
+        """ Import all elements from an iterable of ElementTree elements. """
+
+        for batch in _batches(elements, batch_size):
+            self.import_chunk([self._parse(e) for e in batch])
+
+def _bulk_import_osm_xml(osma, session, xml, batch_size=10000):
+    """ Bulk import a string in OSM XML format into an OSMAlchemy model.
+
+      osma - reference to the OSMAlchemy model instance
+      session - an SQLAlchemy session
+      xml - string containing the XML data
+      batch_size - number of elements to import per transaction, None for one transaction
+    """
+
+    # The parser expects encoded data
+    if not isinstance(xml, bytes):
+        xml = xml.encode("utf-8")
+
+    _BulkImporter(osma, session).run(_iterparse_osm(BytesIO(xml)), batch_size)
+
+def _bulk_import_osm_file(osma, session, file, batch_size=10000):
+    """ Bulk import a file in OSM XML format into an OSMAlchemy model.
+
+      osma - reference to the OSMAlchemy model instance
+      session - an SQLAlchemy session
+      path - path to the file to import or open file object
+      batch_size - number of elements to import per transaction, None for one transaction
+    """
+
+    _BulkImporter(osma, session).run(_iterparse_osm(file), batch_size)
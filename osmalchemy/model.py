@@ -33,25 +33,192 @@ not historic data.
 """
 
 import datetime
+from itertools import chain
+try:
+    from collections.abc import MutableMapping
+except ImportError:
+    # Python 2
+    from collections import MutableMapping
 from sqlalchemy import (Column, ForeignKey, Integer, BigInteger, Numeric, String, Unicode,
-                        DateTime, Boolean, UniqueConstraint)
+                        DateTime, Boolean, JSON, UniqueConstraint, Index, and_, exists, inspect)
+from sqlalchemy.dialects import mysql, postgresql
+from sqlalchemy.event import listens_for
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.ext.associationproxy import association_proxy
 from sqlalchemy.ext.orderinglist import ordering_list
-from sqlalchemy.orm import relationship, backref
+from sqlalchemy.orm import relationship, backref, Session
+from sqlalchemy.orm.attributes import set_committed_value
 from sqlalchemy.orm.collections import attribute_mapped_collection
+from sqlalchemy.types import TypeDecorator
 
-def _generate_model(base, prefix="osm_"):
+from .util import _LRUCache, _intern_tags, _tile, _update_bounds
+
+def _intersects_bbox(cls, south, west, north, east):
+    """ Get a filter expression for elements whose bounding box intersects a box.
+
+    Used as intersects_bbox class method of ways and relations.
+    """
+
+    return and_(cls.min_latitude <= north, cls.max_latitude >= south,
+                cls.min_longitude <= east, cls.max_longitude >= west)
+
+class _FixedPoint(TypeDecorator):
+    """ Coordinate stored as integer in units of 1e-7 degrees, like OSM does.
+
+    Values are exposed as floats and compared as integers in the database.
+    """
+
+    impl = Integer
+    cache_ok = True
+
+    # Number of units per degree
+    scale = 10000000
+
+    def process_bind_param(self, value, dialect):
+        if value is None:
+            return None
+        return int(round(float(value) * self.scale))
+
+    def process_result_value(self, value, dialect):
+        if value is None:
+            return None
+        return value / float(self.scale)
+
+class _TagDict(dict):
+    """ Tags of an element read from its JSON column.
+
+    Changes are written through to the JSON column and the tag tables.
+    """
+
+    def __init__(self, element, tags):
+        dict.__init__(self, tags)
+        self._element = element
+
+    def __setitem__(self, key, value):
+        dict.__setitem__(self, key, value)
+        self._element._tags[key] = value
+        self._element.tags_json = dict(self)
+
+    def __delitem__(self, key):
+        dict.__delitem__(self, key)
+        del self._element._tags[key]
+        self._element.tags_json = dict(self)
+
+    # Other changes are made through the methods above
+    clear = MutableMapping.clear
+    pop = MutableMapping.pop
+    popitem = MutableMapping.popitem
+    setdefault = MutableMapping.setdefault
+    update = MutableMapping.update
+
+def _get_json_tags(element):
+    """ Getter for the tags of elements if they are stored as JSON. """
+
+    if element.tags_json is None:
+        # Not stored as JSON yet, e.g. created before enabling it
+        return _TagDict(element, element._tags)
+    return _TagDict(element, element.tags_json)
+
+def _set_json_tags(element, tags):
+    """ Setter for the tags of elements if they are stored as JSON. """
+
+    tags = dict(tags)
+    element._tags = tags
+    element.tags_json = tags
+
+class _FlushHandlers(object):
+    """ Handlers for flush events of the classes of one generated model.
+
+    Sessions have one listener per event for all models, calling the
+    handlers of the models that have objects in a flush.
+    """
+
+    def __init__(self):
+        self.before_flush = []
+        self.after_flush = []
+        self.after_flush_postexec = []
+
+def _flushed_models(session):
+    """ Get the flush handlers of all models with objects in a session. """
+
+    models = set()
+    for obj in chain(session.new, session.dirty, session.deleted):
+        handlers = getattr(obj, "_osmalchemy_flush_handlers", None)
+        if handlers is not None:
+            models.add(handlers)
+    return models
+
+@listens_for(Session, "before_flush")
+def _before_flush(session, flush_context, instances):
+    """ Call before_flush handlers of models with objects in the flush. """
+
+    for handlers in _flushed_models(session):
+        for handler in handlers.before_flush:
+            handler(session, flush_context, instances)
+
+@listens_for(Session, "after_flush")
+def _after_flush(session, flush_context):
+    """ Call after_flush handlers of models with objects in the flush. """
+
+    models = _flushed_models(session)
+    for handlers in models:
+        for handler in handlers.after_flush:
+            handler(session, flush_context)
+
+    # Objects are no longer known as flushed after the flush, so remember models
+    if models:
+        session.info.setdefault(_FlushHandlers, set()).update(models)
+
+@listens_for(Session, "after_flush_postexec")
+def _after_flush_postexec(session, flush_context):
+    """ Call after_flush_postexec handlers of models that had objects in the flush. """
+
+    for handlers in session.info.pop(_FlushHandlers, ()):
+        for handler in handlers.after_flush_postexec:
+            handler(session, flush_context)
+
+def _generate_model(base, prefix="osm_", fixed_point=False, polymorphic="selectin",
+                    json_tags=False):
     """ Generates the data model.
 
     The model classes are generated dynamically to allow passing in a
-    declarative base and a prefix.
+    declarative base and a prefix. If fixed_point is True, coordinates
+    are stored as integers in units of 1e-7 degrees instead of decimals.
+
+    polymorphic selects how queries for elements load the columns of
+    nodes, ways and relations: None to load them lazily per element,
+    "selectin" to load them in one query per type after the elements,
+    or "*" to join all tables into every query for elements.
+
+    If json_tags is True, the tags of elements are also stored in a JSON
+    column, which serves reads of all tags of an element.
     """
 
+    if polymorphic not in (None, "selectin", "*"):
+        raise ValueError("Invalid argument passed to polymorphic parameter.")
+
+    def _polymorphic_args(identity):
+        # Mapper arguments of the element types
+        args = {'polymorphic_identity': identity}
+        if polymorphic == "selectin":
+            args['polymorphic_load'] = 'selectin'
+        return args
+
+    def _coordinate_type(precision):
+        # Type of latitude and longitude columns
+        if fixed_point:
+            return _FixedPoint()
+        else:
+            return Numeric(precision=precision, asdecimal=False)
+
     class OSMTag(base):
         """ An OSM tag element.
 
-        Simple key/value pair.
+        Simple key/value pair. Every pair is stored only once and shared
+        by all elements that have it. New tags are never stored themselves:
+        on flush, they are replaced by the stored equal tag, created if
+        needed, and removed from the session with its tag_id set. Query
+        for tags to get the stored objects.
         """
 
         # Name of the table in the database, prefix provided by user
@@ -60,9 +227,12 @@ def _generate_model(base, prefix="osm_"):
         # The internal ID of the element, only for structural use
         tag_id = Column(BigInteger().with_variant(Integer, "sqlite"), primary_key=True)
 
-        # Key/value pair
-        key = Column(Unicode(256))
-        value = Column(Unicode(256))
+        # Key/value pair, compared case-sensitively on MySQL as well
+        key = Column(Unicode(256).with_variant(mysql.VARCHAR(256, binary=True), "mysql"))
+        value = Column(Unicode(256).with_variant(mysql.VARCHAR(256, binary=True), "mysql"))
+
+        # Tags are unique, which also indexes lookups by key and value
+        __table_args__ = (UniqueConstraint("key", "value"),)
 
         def __init__(self, key="", value="", **kwargs):
             """ Initialisation with two main positional arguments.
@@ -101,6 +271,13 @@ def _generate_model(base, prefix="osm_"):
         tags = association_proxy(prefix+"elements_tags", "tag_value",
                                  creator=lambda k, v: OSMElementsTags(tag_key=k, tag_value=v))
 
+        # Tags also stored as JSON if enabled, written to both and read from JSON
+        # The tag tables are still used for querying by tags
+        if json_tags:
+            tags_json = Column(JSON().with_variant(postgresql.JSONB(), "postgresql"))
+            _tags = tags
+            tags = property(_get_json_tags, _set_json_tags)
+
         # Metadata shared by all element types
         version = Column(Integer)
         changeset = Column(BigInteger)
@@ -109,16 +286,35 @@ def _generate_model(base, prefix="osm_"):
         visible = Column(Boolean)
         timestamp = Column(DateTime)
 
-        # OSM ids are unique per type
-        _u_type_id = UniqueConstraint("type", "id")
+        # OSM ids are unique per type, id first so lookups by id alone use the index
+        # Update times are indexed for finding expired elements
+        __table_args__ = (UniqueConstraint("id", "type"),
+                          Index(prefix + "ix_elements_osmalchemy_updated", "osmalchemy_updated"))
 
-        # Configure polymorphism
+        # Configure polymorphism, joining all element types only if asked to
         __mapper_args__ = {
             'polymorphic_identity': 'element',
             'polymorphic_on': type,
-            'with_polymorphic': '*'
+            'with_polymorphic': polymorphic if polymorphic == '*' else None
         }
 
+        @classmethod
+        def has_tag(cls, key, value=None):
+            """ Get a filter expression for elements having a tag.
+
+              key - the key of the tag
+              value - optional; the value of the tag, None for any value
+            """
+
+            # Look up tag by key, and value if given
+            criteria = [OSMElementsTags.element_id == cls.element_id,
+                        OSMTag.tag_id == OSMElementsTags.tag_id, OSMTag.key == key]
+            if value is not None:
+                criteria.append(OSMTag.value == value)
+
+            # Mark as tag filter, so it can be understood for online queries
+            return exists().where(and_(*criteria))._annotate({"osmalchemy_tag": (cls, key, value)})
+
     class OSMElementsTags(base):
         """ Secondary mapping table for elements and tags """
 
@@ -134,6 +330,10 @@ def _generate_model(base, prefix="osm_"):
         tag_id = Column(BigInteger().with_variant(Integer, "sqlite"),
                         ForeignKey(prefix + 'tags.tag_id'))
 
+        # Indexes for loading tags of elements and finding elements by tag
+        __table_args__ = (Index(prefix + "ix_elements_tags_element_id", "element_id"),
+                          Index(prefix + "ix_elements_tags_tag_id", "tag_id", "element_id"))
+
         # Relationship with all the tags mapped to the element
         # The backref is the counter-part to the tags association proxy
         # in OSMElement to form the dictionary
@@ -142,11 +342,35 @@ def _generate_model(base, prefix="osm_"):
                                                collection_class=attribute_mapped_collection("tag_key"),
                                                cascade="all, delete-orphan"))
 
-        # Relationship to the tag object and short-hand for its key and value
-        # for use in the association proxy
+        # Relationship to the tag object
         tag = relationship(OSMTag, foreign_keys=[tag_id])
-        tag_key = association_proxy("tag", "key")
-        tag_value = association_proxy("tag", "value")
+
+        def __init__(self, tag_key="", tag_value="", **kwargs):
+            """ Initialisation with the key and value of the tag. """
+
+            # Always refer to a new tag, replaced by an existing equal one on flush
+            self.tag = OSMTag(tag_key, tag_value)
+
+            # Pass rest on to default constructor
+            base.__init__(self, **kwargs)
+
+        # Short-hand for the key and value of the tag for use in the association proxy
+        # Tags are shared, so changing them refers to a new tag instead of modifying it
+        @property
+        def tag_key(self):
+            return self.tag.key
+
+        @tag_key.setter
+        def tag_key(self, key):
+            self.tag = OSMTag(key, self.tag.value)
+
+        @property
+        def tag_value(self):
+            return self.tag.value
+
+        @tag_value.setter
+        def tag_value(self, value):
+            self.tag = OSMTag(self.tag.key, value)
 
     class OSMNode(OSMElement):
         """ An OSM node element.
@@ -165,13 +389,20 @@ def _generate_model(base, prefix="osm_"):
 
 
         # Geographical coordinates of the node
-        latitude = Column(Numeric(precision="9,7", asdecimal=False))
-        longitude = Column(Numeric(precision="10,7", asdecimal=False))
+        latitude = Column(_coordinate_type("9,7"))
+        longitude = Column(_coordinate_type("10,7"))
+
+        # Morton-coded grid tile of the coordinates, for spatial indexing
+        # Maintained automatically on insert and update
+        tile = Column(BigInteger)
+
+        # Indexes for range queries on coordinates and tiles
+        __table_args__ = (Index(prefix + "ix_nodes_latitude_longitude",
+                                "latitude", "longitude"),
+                          Index(prefix + "ix_nodes_tile", "tile"))
 
         # Configure polymorphism with OSMElement
-        __mapper_args__ = {
-            'polymorphic_identity': 'node',
-        }
+        __mapper_args__ = _polymorphic_args('node')
 
         def __init__(self, latitude=None, longitude=None, **kwargs):
             """ Initialisation with two main positional arguments.
@@ -185,6 +416,13 @@ def _generate_model(base, prefix="osm_"):
             # Pass rest on to default constructor
             OSMElement.__init__(self, **kwargs)
 
+    @listens_for(OSMNode, "before_insert")
+    @listens_for(OSMNode, "before_update")
+    def _update_tile(mapper, connection, target):
+        """ Keep the tile of a node in sync with its coordinates. """
+
+        target.tile = _tile(target.latitude, target.longitude)
+
     class OSMWaysNodes(base):
         """ Secondary mapping table for ways and nodes """
 
@@ -205,6 +443,10 @@ def _generate_model(base, prefix="osm_"):
         # Index of the node in the way to maintain ordered list, structural use only
         position = Column(Integer)
 
+        # Indexes for loading nodes of ways and finding ways using a node
+        __table_args__ = (Index(prefix + "ix_ways_nodes_way_id", "way_id", "position"),
+                          Index(prefix + "ix_ways_nodes_node_id", "node_id"))
+
     class OSMWay(OSMElement):
         """ An OSM way element (also area).
 
@@ -224,14 +466,26 @@ def _generate_model(base, prefix="osm_"):
         # Uses association proxy and a collection class to maintain an ordered list,
         # synchronised with the position field of OSMWaysNodes
         _nodes = relationship(OSMWaysNodes, order_by="OSMWaysNodes.position",
-                              collection_class=ordering_list("position"))
+                              collection_class=ordering_list("position"),
+                              cascade="all, delete-orphan")
         nodes = association_proxy("_nodes", "node",
                                   creator=lambda _n: OSMWaysNodes(node=_n))
 
+        # Bounding box of all nodes, maintained automatically on flush
+        min_latitude = Column(_coordinate_type("9,7"))
+        max_latitude = Column(_coordinate_type("9,7"))
+        min_longitude = Column(_coordinate_type("10,7"))
+        max_longitude = Column(_coordinate_type("10,7"))
+
+        # Index for filtering by bounding box
+        __table_args__ = (Index(prefix + "ix_ways_bounds", "min_latitude", "max_latitude",
+                                "min_longitude", "max_longitude"),)
+
+        # Filter expression for elements intersecting a bounding box
+        intersects_bbox = classmethod(_intersects_bbox)
+
         # Configure polymorphism with OSMElement
-        __mapper_args__ = {
-            'polymorphic_identity': 'way',
-        }
+        __mapper_args__ = _polymorphic_args('way')
 
     class OSMRelationsElements(base):
         """ Secondary mapping table for relation members """
@@ -256,6 +510,11 @@ def _generate_model(base, prefix="osm_"):
         # Index of element in the relationship to maintain ordered list, structural use only
         position = Column(Integer)
 
+        # Indexes for loading members of relations and finding relations using an element
+        __table_args__ = (Index(prefix + "ix_relations_elements_relation_id",
+                                "relation_id", "position"),
+                          Index(prefix + "ix_relations_elements_element_id", "element_id"))
+
         # Produce (element, role) tuple for proxy access in OSMRelation
         @property
         def role_tuple(self):
@@ -279,16 +538,131 @@ def _generate_model(base, prefix="osm_"):
         # Relationship to the members of the relationship, proxied across OSMRelationsElements
         _members = relationship(OSMRelationsElements,
                                 order_by="OSMRelationsElements.position",
-                                collection_class=ordering_list("position"))
+                                collection_class=ordering_list("position"),
+                                cascade="all, delete-orphan")
         # Accessed as a list like [(element, "role"), (element2, "role2")]
         members = association_proxy("_members", "role_tuple",
                                     creator=lambda _m: OSMRelationsElements(element=_m[0],
                                                                             role=_m[1]))
 
+        # Bounding box of all members, maintained automatically on flush
+        min_latitude = Column(_coordinate_type("9,7"))
+        max_latitude = Column(_coordinate_type("9,7"))
+        min_longitude = Column(_coordinate_type("10,7"))
+        max_longitude = Column(_coordinate_type("10,7"))
+
+        # Index for filtering by bounding box
+        __table_args__ = (Index(prefix + "ix_relations_bounds", "min_latitude", "max_latitude",
+                                "min_longitude", "max_longitude"),)
+
+        # Filter expression for elements intersecting a bounding box
+        intersects_bbox = classmethod(_intersects_bbox)
+
         # Configure polymorphism with OSMElement
-        __mapper_args__ = {
-            'polymorphic_identity': 'relation',
-        }
+        __mapper_args__ = _polymorphic_args('relation')
+
+    # Cache of (key, value) to tag_id for interning tags
+    tag_cache = _LRUCache()
+
+    def _intern_new_tags(session, flush_context, instances):
+        """ Replace new tags with existing, equal ones before flushing.
+
+        Missing tags are inserted beforehand, so concurrent sessions
+        creating the same tag do not conflict.
+        """
+
+        # Find new tags in the session
+        new_tags = set(obj for obj in session.new if isinstance(obj, OSMTag))
+        if not new_tags:
+            return
+
+        # Get or create tags, then load them as objects
+        tag_ids = _intern_tags(session.connection(), OSMTag.__table__,
+                               [(tag.key, tag.value) for tag in new_tags], tag_cache)
+        tags = {}
+        ids = list(tag_ids.values())
+        for i in range(0, len(ids), 500):
+            for tag in session.query(OSMTag).filter(OSMTag.tag_id.in_(ids[i:i+500])):
+                tags[(tag.key, tag.value)] = tag
+
+        # Cached ids can be stale if the transaction creating them was rolled back
+        stale = [pair for pair in tag_ids if pair not in tags]
+        if stale:
+            for pair in stale:
+                tag_cache.discard(pair)
+            tag_ids = _intern_tags(session.connection(), OSMTag.__table__, stale, tag_cache)
+            for tag in session.query(OSMTag).filter(OSMTag.tag_id.in_(tag_ids.values())):
+                tags[(tag.key, tag.value)] = tag
+
+        # Make all mappings refer to the existing tags
+        for obj in session.new.union(session.dirty):
+            if isinstance(obj, OSMElementsTags) and obj.tag in new_tags:
+                obj.tag = tags[(obj.tag.key, obj.tag.value)]
+
+        # Drop the new tags, leaving them with the id of the stored tag
+        for tag in new_tags:
+            session.expunge(tag)
+            tag.tag_id = tags[(tag.key, tag.value)].tag_id
+
+    # Tables needed for maintaining bounding boxes
+    bounds_tables = {"node": OSMNode.__table__, "way": OSMWay.__table__,
+                     "relation": OSMRelation.__table__,
+                     "ways_nodes": OSMWaysNodes.__table__,
+                     "relations_elements": OSMRelationsElements.__table__}
+
+    def _update_flushed_bounds(session, flush_context):
+        """ Update bounding boxes of ways and relations affected by a flush. """
+
+        # Find changed nodes and changed ways and relations, including their mappings
+        node_ids, way_ids, relation_ids = set(), set(), set()
+        new = session.new
+        for obj in new.union(session.dirty).union(session.deleted):
+            if isinstance(obj, OSMNode) and obj not in new:
+                attrs = inspect(obj).attrs
+                if attrs.latitude.history.has_changes() or attrs.longitude.history.has_changes():
+                    node_ids.add(obj.element_id)
+            elif isinstance(obj, OSMWay):
+                way_ids.add(obj.element_id)
+            elif isinstance(obj, OSMWaysNodes):
+                way_ids.add(obj.way_id)
+            elif isinstance(obj, OSMRelation):
+                relation_ids.add(obj.element_id)
+            elif isinstance(obj, OSMRelationsElements):
+                relation_ids.add(obj.relation_id)
+        node_ids.discard(None)
+        way_ids.discard(None)
+        relation_ids.discard(None)
+
+        if node_ids or way_ids or relation_ids:
+            # Store new bounds to update objects after the flush
+            bounds = _update_bounds(session.connection(), bounds_tables,
+                                    node_ids, way_ids, relation_ids)
+            session.info.setdefault(OSMWay, {}).update(bounds)
+
+    def _refresh_flushed_bounds(session, flush_context):
+        """ Set updated bounding boxes on ways and relations loaded in the session. """
+
+        bounds = session.info.pop(OSMWay, None)
+        if not bounds:
+            return
+
+        classes = {"way": inspect(OSMWay), "relation": inspect(OSMRelation)}
+        for (type, element_id), values in bounds.items():
+            key = classes[type].identity_key_from_primary_key([element_id])
+            obj = session.identity_map.get(key)
+            if obj is not None:
+                for name, value in zip(("min_latitude", "max_latitude",
+                                        "min_longitude", "max_longitude"), values):
+                    set_committed_value(obj, name, value)
+
+    # Register flush handlers with all classes of the model
+    flush_handlers = _FlushHandlers()
+    flush_handlers.before_flush.append(_intern_new_tags)
+    flush_handlers.after_flush.append(_update_flushed_bounds)
+    flush_handlers.after_flush_postexec.append(_refresh_flushed_bounds)
+    for cls in (OSMTag, OSMElement, OSMElementsTags, OSMWaysNodes, OSMRelationsElements):
+        cls._osmalchemy_flush_handlers = flush_handlers
 
     # Return the relevant generated objects
-    return (OSMNode, OSMWay, OSMRelation, OSMElement)
+    return (OSMNode, OSMWay, OSMRelation, OSMElement,
+            OSMTag, OSMElementsTags, OSMWaysNodes, OSMRelationsElements)
@@ -27,8 +27,31 @@
 
 """ Utility code for OSMAlchemy's online functionality. """
 
+import hashlib
+import os
+import re
+import tempfile
+import threading
+import time
+import zlib
+from contextlib import contextmanager
+
+try:
+    import fcntl
+except ImportError:
+    # non-fatal, locking across processes is only supported on POSIX systems
+    fcntl = None
+
 import overpass
 
+from .util import _import_osm_xml
+
+# Start of an element in an XML response
+_XML_ELEMENT = re.compile(r"<(node|way|relation)[\s/>]")
+
+# Element types in the order they are put into queries, nwr selects any type
+_TYPES = ("node", "way", "relation", "nwr")
+
 def _generate_overpass_api(endpoint=None):
     """ Create and initialise the Overpass API object.
 
@@ -45,6 +68,210 @@ def _generate_overpass_api(endpoint=None):
 
     return api
 
+class _OverpassCache(object):
+    """ Persistent cache of Overpass responses on disk.
+
+    Wraps an Overpass API object and provides the same Get method. Responses
+    are stored zlib-compressed in one file per query, named by the SHA-256
+    hash of the normalised query and response format, so several processes
+    can share a cache directory. File modification times record when a
+    response was fetched, access times when it was last used; the least
+    recently used responses are removed when the cache grows too large.
+    XML responses without any elements are not stored, so elements not
+    found are asked for again once callers stop remembering them.
+    """
+
+    def __init__(self, api, directory, ttl=60*60*24, max_size=256*1024*1024):
+        """ Create a cache in a directory, creating it if needed.
+
+          api - the Overpass API object to fetch missing responses from
+          directory - path of the directory to store responses in
+          ttl - time in seconds after which responses are fetched again
+          max_size - maximum total size of stored responses in bytes
+        """
+
+        self.api = api
+        self.directory = directory
+        self.ttl = ttl
+        self.max_size = max_size
+
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+
+    def _path(self, query, responseformat):
+        # Normalise whitespace, so formatting does not change the key
+        key = "%s\n%s" % (" ".join(query.split()), responseformat)
+        digest = hashlib.sha256(key.encode("utf-8")).hexdigest()
+        return os.path.join(self.directory, "%s.%s.z" % (digest, responseformat))
+
+    def _read(self, path):
+        # Read response, None if it is missing, expired or unreadable
+        try:
+            if time.time() - os.stat(path).st_mtime > self.ttl:
+                return None
+            with open(path, "rb") as f:
+                data = zlib.decompress(f.read())
+
+            # Mark as used, keeping the time of fetching
+            os.utime(path, (time.time(), os.stat(path).st_mtime))
+        except (IOError, OSError, zlib.error):
+            return None
+
+        return data.decode("utf-8")
+
+    def _write(self, path, response):
+        # Write to a temporary file first, so readers never see partial files
+        data = response if isinstance(response, bytes) else response.encode("utf-8")
+        try:
+            fd, tmp = tempfile.mkstemp(dir=self.directory, suffix=".tmp")
+            with os.fdopen(fd, "wb") as f:
+                f.write(zlib.compress(data))
+            os.rename(tmp, path)
+        except (IOError, OSError):
+            # Caching is best effort
+            return
+
+        self._evict()
+
+    def _evict(self):
+        # Collect size and access time of all responses
+        entries = []
+        for name in os.listdir(self.directory):
+            if name.endswith(".z"):
+                try:
+                    st = os.stat(os.path.join(self.directory, name))
+                except OSError:
+                    # Removed concurrently
+                    continue
+                entries.append((st.st_atime, st.st_size, name))
+
+        # Remove least recently used responses until the cache is small enough
+        size = sum(entry[1] for entry in entries)
+        for atime, entry_size, name in sorted(entries):
+            if size <= self.max_size:
+                break
+            try:
+                os.remove(os.path.join(self.directory, name))
+            except OSError:
+                pass
+            size -= entry_size
+
+    def Get(self, query, responseformat="xml"):
+        """ Run a query, using a stored response if it is fresh enough.
+
+          query - the Overpass QL query
+          responseformat - the format of the response, passed to the API
+        """
+
+        path = self._path(query, responseformat)
+
+        # Use stored response if possible
+        response = self._read(path)
+        if response is None:
+            # Fetch and store response, unless it did not find anything
+            response = self.api.Get(query, responseformat=responseformat)
+            if responseformat != "xml" or _XML_ELEMENT.search(response):
+                self._write(path, response)
+
+        return response
+
+    def responses(self, expired=False):
+        """ Get all stored XML responses, oldest first.
+
+          expired - whether to include responses older than the TTL
+        """
+
+        # Order by time of fetching, so newer data overwrites older data
+        entries = []
+        for name in os.listdir(self.directory):
+            if name.endswith(".xml.z"):
+                try:
+                    entries.append((os.stat(os.path.join(self.directory, name)).st_mtime, name))
+                except OSError:
+                    continue
+
+        for mtime, name in sorted(entries):
+            path = os.path.join(self.directory, name)
+            if not expired and time.time() - mtime > self.ttl:
+                continue
+            try:
+                with open(path, "rb") as f:
+                    yield zlib.decompress(f.read()).decode("utf-8")
+            except (IOError, OSError, zlib.error):
+                continue
+
+    def replay(self, osma, session, expired=False):
+        """ Import all stored XML responses into an OSMAlchemy model.
+
+          osma - reference to the OSMAlchemy model instance
+          session - an SQLAlchemy session
+          expired - whether to include responses older than the TTL
+        """
+
+        for xml in self.responses(expired):
+            _import_osm_xml(osma, session, xml)
+
+class _SingleFlight(object):
+    """ Lets only one caller at a time fetch data for the same key.
+
+    Concurrent callers for a key wait until the first one is done, and can
+    then find the data in the database instead of fetching it again. Keys
+    are locked within the process, and across processes using file locks
+    in a shared directory, if given and supported.
+    """
+
+    # Number of lock files keys are distributed over
+    stripes = 256
+
+    def __init__(self, directory=None):
+        """ Create locks, optionally shared with other processes.
+
+          directory - optional; directory to keep lock files in
+        """
+
+        self.directory = directory
+        self._lock = threading.Lock()
+        self._locks = {}
+
+        if directory is not None and not os.path.isdir(directory):
+            os.makedirs(directory)
+
+    @contextmanager
+    def _file_lock(self, key):
+        # Distribute keys over a fixed number of lock files
+        stripe = int(hashlib.sha256(key.encode("utf-8")).hexdigest()[:8], 16) % self.stripes
+        with open(os.path.join(self.directory, "flight-%03d.lock" % stripe), "a") as f:
+            fcntl.flock(f.fileno(), fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(f.fileno(), fcntl.LOCK_UN)
+
+    @contextmanager
+    def flight(self, key):
+        """ Context manager holding the lock for a key.
+
+          key - string identifying the data to fetch, e.g. an Overpass query
+        """
+
+        # Get lock of the key, counting users to remove it when unused
+        with self._lock:
+            entry = self._locks.setdefault(key, [threading.Lock(), 0])
+            entry[1] += 1
+
+        try:
+            with entry[0]:
+                if self.directory is not None and fcntl is not None:
+                    with self._file_lock(key):
+                        yield
+                else:
+                    yield
+        finally:
+            with self._lock:
+                entry[1] -= 1
+                if not entry[1]:
+                    del self._locks[key]
+
 def _get_single_element_by_id(api, type, id, recurse_down=True):
     """ Retrieves a single OpenStreetMap element by its id.
 
@@ -62,3 +289,292 @@ def _get_single_element_by_id(api, type, id, recurse_down=True):
 
     # Return data
     return r
+
+def _overpass_union(elements):
+    """ Construct an Overpass QL union statement selecting elements by id.
+
+      elements - iterable of (type, id) tuples, types may be mixed, type
+                 "nwr" selects elements of any type with the id
+    """
+
+    # Group ids by type, dropping duplicates
+    ids = {}
+    for type, id in elements:
+        if type not in _TYPES:
+            raise ValueError("Unknown element type %s." % type)
+        ids.setdefault(type, set()).add(int(id))
+
+    # One id filter per type, all within one union
+    parts = ["%s(id:%s);" % (type, ",".join(str(id) for id in sorted(ids[type])))
+             for type in _TYPES if type in ids]
+    return "(%s);" % "".join(parts)
+
+def _get_elements_by_id(api, elements, recurse_down=True, chunk_size=500):
+    """ Retrieves many OpenStreetMap elements by their ids, in few queries.
+
+    Elements of all types are packed into a single union query, so
+    fetching a set of elements only needs one round trip per chunk
+    instead of one per element. Returns a list of XML responses.
+
+      api - an initialised Overpass API object
+      elements - iterable of (type, id) tuples
+      recurse_down - whether to get child nodes of ways and relations
+      chunk_size - maximum number of elements per query
+    """
+
+    # Sort to build the same queries for the same elements
+    elements = sorted(set((type, int(id)) for type, id in elements))
+
+    responses = []
+    for i in range(0, len(elements), chunk_size):
+        # Construct query
+        q = "%s%s" % (_overpass_union(elements[i:i+chunk_size]),
+                      "(._;>;);" if recurse_down else "")
+
+        # Run query
+        responses.append(api.Get(q, responseformat="xml"))
+
+    # Return data
+    return responses
+
+def _import_elements_by_id(osma, session, api, elements, recurse_down=True, chunk_size=500):
+    """ Retrieves many OpenStreetMap elements by their ids and imports them.
+
+      osma - reference to the OSMAlchemy model instance
+      session - an SQLAlchemy session
+      api - an initialised Overpass API object
+      elements - iterable of (type, id) tuples
+      recurse_down - whether to get child nodes of ways and relations
+      chunk_size - maximum number of elements per query
+    """
+
+    for xml in _get_elements_by_id(api, elements, recurse_down, chunk_size):
+        _import_osm_xml(osma, session, xml)
+
+# Maximum number of statements in a generated union
+_MAX_STATEMENTS = 64
+
+# Bounding box sides (south, west, north, east) bounded by comparisons on fields,
+# the bounds of ways and relations select those intersecting the box
+_BBOX_SIDES = {"latitude": {">": 0, ">=": 0, "<": 2, "<=": 2, "==": (0, 2)},
+               "longitude": {">": 1, ">=": 1, "<": 3, "<=": 3, "==": (1, 3)},
+               "max_latitude": {">": 0, ">=": 0},
+               "min_latitude": {"<": 2, "<=": 2},
+               "max_longitude": {">": 1, ">=": 1},
+               "min_longitude": {"<": 3, "<=": 3}}
+
+# Open bounding box sides are filled from the whole world
+_WORLD = (-90.0, -180.0, 90.0, 180.0)
+
+def _overpass_leaf(op, field, value):
+    """ Convert a comparison from a clause tree to a conjunction of filters.
+
+    Conjunctions are dictionaries with the optional keys ids (set of ids),
+    bbox (list of south, west, north and east, None where open), key (key
+    of a joined tag), values (tuple of (op, value) tuples for the joined tag)
+    and tags (tuple of (key, value) tuples of tags the element has, value
+    None for any). Comparisons that cannot be expressed in Overpass QL result
+    in an empty conjunction matching anything, those that cannot be true in
+    None.
+    """
+
+    if field == "id" and op == "==":
+        return {"ids": frozenset([int(value)])}
+    elif field == "id" and op == "in":
+        if not value:
+            return None
+        return {"ids": frozenset(int(id) for id in value)}
+    elif field == "tags" and op == "has":
+        return {"tags": (value,)}
+    elif field in _BBOX_SIDES and op in _BBOX_SIDES[field]:
+        sides = _BBOX_SIDES[field][op]
+        bbox = [None] * 4
+        for side in (sides if type(sides) is tuple else (sides,)):
+            bbox[side] = float(value)
+        return {"bbox": bbox}
+    elif field == "tag.key" and op == "==":
+        return {"key": value}
+    elif field == "tag.value" and op in ("==", "!=", "in", "like", "ilike"):
+        if op == "in" and not value:
+            return None
+        return {"values": ((op, value),)}
+    else:
+        return {}
+
+def _overpass_merge(a, b):
+    """ Merge two conjunctions of filters, None if they contradict each other. """
+
+    merged = {}
+
+    # Intersect id sets
+    if "ids" in a and "ids" in b:
+        merged["ids"] = a["ids"] & b["ids"]
+        if not merged["ids"]:
+            return None
+    elif "ids" in a or "ids" in b:
+        merged["ids"] = a.get("ids", b.get("ids"))
+
+    # Tighten bounding box, south and west upwards, north and east downwards
+    if "bbox" in a or "bbox" in b:
+        bbox = []
+        for side, pick in enumerate((max, max, min, min)):
+            values = [c["bbox"][side] for c in (a, b)
+                      if "bbox" in c and c["bbox"][side] is not None]
+            bbox.append(pick(values) if values else None)
+        if (bbox[0] is not None and bbox[2] is not None and bbox[0] > bbox[2]) or \
+           (bbox[1] is not None and bbox[3] is not None and bbox[1] > bbox[3]):
+            return None
+        merged["bbox"] = bbox
+
+    # A joined tag has only one key
+    if "key" in a and "key" in b and a["key"] != b["key"]:
+        return None
+    elif "key" in a or "key" in b:
+        merged["key"] = a.get("key", b.get("key"))
+    if "values" in a or "values" in b:
+        merged["values"] = a.get("values", ()) + b.get("values", ())
+
+    # Tags of the element are all required
+    if "tags" in a or "tags" in b:
+        merged["tags"] = a.get("tags", ()) + b.get("tags", ())
+
+    return merged
+
+def _overpass_conjunctions(tree):
+    """ Convert a clause tree into a list of conjunctions, all of which are united.
+
+    Returns None if the result gets too large.
+    """
+
+    op = tree[0]
+    if op == "&&":
+        # Merge each conjunction of the result so far with each of the clause
+        result = [{}]
+        for clause in tree[1]:
+            conjunctions = _overpass_conjunctions(clause)
+            if conjunctions is None:
+                return None
+            result = [c for c in (_overpass_merge(a, b) for a in result for b in conjunctions)
+                      if c is not None]
+            if len(result) > _MAX_STATEMENTS:
+                return None
+        return result
+    elif op == "||":
+        # Unsupported clauses were left out, so nothing left means anything
+        if not tree[1]:
+            return [{}]
+
+        # Unite conjunctions of all clauses
+        result = []
+        for clause in tree[1]:
+            conjunctions = _overpass_conjunctions(clause)
+            if conjunctions is None:
+                return None
+            result += conjunctions
+        if len(result) > _MAX_STATEMENTS:
+            return None
+        return result
+    else:
+        conjunction = _overpass_leaf(*tree)
+        return [] if conjunction is None else [conjunction]
+
+def _overpass_string(value):
+    """ Quote a string for use in Overpass QL. """
+
+    return '"%s"' % value.replace("\\", "\\\\").replace('"', '\\"')
+
+def _overpass_regex(value):
+    """ Escape a string for use in a regular expression in Overpass QL. """
+
+    return "".join("\\" + c if c in "\\^$.|?*+()[]{}" else c for c in value)
+
+def _overpass_tag_filter(key, op=None, value=None):
+    """ Construct an Overpass QL filter on a tag.
+
+      key - the key of the tag
+      op - the comparison of the value, one of ==, !=, in, like and ilike,
+           None to only require the key
+      value - the value to compare to, a list for in, a pattern for like and ilike
+    """
+
+    key = _overpass_string(key)
+    if op is None:
+        return "[%s]" % key
+    elif op == "==":
+        return "[%s=%s]" % (key, _overpass_string(value))
+    elif op == "!=":
+        return "[%s!=%s]" % (key, _overpass_string(value))
+    elif op == "in":
+        regex = "^(%s)$" % "|".join(_overpass_regex(v) for v in value)
+        return "[%s~%s]" % (key, _overpass_string(regex))
+    else:
+        # Translate LIKE pattern to regular expression
+        regex = "^%s$" % "".join({"%": ".*", "_": "."}.get(c, _overpass_regex(c)) for c in value)
+        return "[%s~%s%s]" % (key, _overpass_string(regex), ",i" if op == "ilike" else "")
+
+def _overpass_query(tree, type):
+    """ Compile a clause tree from _analyse_clause into an Overpass QL query.
+
+    Id comparisons and lists become id filters, latitude and longitude
+    ranges become bounding boxes, joined tag keys and values as well as
+    has_tag filters become tag filters, and && and || become intersections
+    and unions. Returns None if no query
+    is needed or no query selecting a limited set of elements can be built,
+    i.e. each part of the union needs ids or a closed bounding box.
+
+      tree - the result of _analyse_clause
+      type - the element type to query, one of node, way, relation or nwr
+    """
+
+    if tree is None:
+        return None
+
+    conjunctions = _overpass_conjunctions(tree)
+    if not conjunctions:
+        # Too large or contradictory
+        return None
+
+    statements = []
+    for c in conjunctions:
+        bbox = c.get("bbox", [None] * 4)
+        if "ids" not in c and None in bbox:
+            # Would select elements from the whole world
+            return None
+
+        # Construct filters
+        statement = type
+        if "ids" in c:
+            statement += "(id:%s)" % ",".join(str(id) for id in sorted(c["ids"]))
+        if "bbox" in c:
+            statement += "(%s)" % ",".join("%.7f" % (side if side is not None else _WORLD[i])
+                                           for i, side in enumerate(bbox))
+        if "key" in c:
+            if c.get("values"):
+                for op, value in c["values"]:
+                    statement += _overpass_tag_filter(c["key"], op, value)
+            else:
+                statement += _overpass_tag_filter(c["key"])
+        for key, value in c.get("tags", ()):
+            if value is None:
+                statement += _overpass_tag_filter(key)
+            else:
+                statement += _overpass_tag_filter(key, "==", value)
+        statements.append(statement + ";")
+
+    # Unite statements, getting child elements for everything but nodes
+    return "(%s);%s" % ("".join(statements), "" if type == "node" else "(._;>;);")
+
+def _overpass_ids(tree):
+    """ Get the set of ids a clause tree from _analyse_clause is limited to.
+
+    Returns None if the tree does not limit all parts of its union to ids.
+    """
+
+    if tree is None:
+        return None
+
+    conjunctions = _overpass_conjunctions(tree)
+    if conjunctions is None or [c for c in conjunctions if "ids" not in c]:
+        return None
+
+    return set().union(*[c["ids"] for c in conjunctions])
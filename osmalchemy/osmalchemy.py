@@ -32,7 +32,7 @@ The classe encapsulates the model and accompanying logic.
 
 from sqlalchemy.engine import Engine
 from sqlalchemy.ext.declarative import declarative_base
-from sqlalchemy.orm import sessionmaker, scoped_session
+from sqlalchemy.orm import selectinload, sessionmaker, scoped_session
 try:
     from flask_sqlalchemy import SQLAlchemy as FlaskSQLAlchemy
 except ImportError:
@@ -41,8 +41,10 @@ except ImportError:
     class FlaskSQLAlchemy(object):
         pass
 
+from .bulk import _bulk_import_osm_file, _deferred_indexes
 from .model import _generate_model
-from .online import _generate_overpass_api
+from .online import _generate_overpass_api, _OverpassCache
+from .queries import _load_way_geometries, _query_bbox, _resolve_relation
 from .util import _import_osm_file
 from .triggers import _generate_triggers
 
@@ -55,7 +57,9 @@ class OSMAlchemy(object):
     different table prefix or a different declarative base.
     """
 
-    def __init__(self, sa, prefix="osm_", overpass=None, maxage=60*60*24):
+    def __init__(self, sa, prefix="osm_", overpass=None, maxage=60*60*24, fixed_point=False,
+                 overpass_cache=None, negative_maxage=60*60, refresh_workers=0,
+                 online_by_default=True, polymorphic="selectin", json_tags=False):
         """ Initialise the table definitions in the wrapper object
 
         This function generates the OSM element classes as SQLAlchemy table
@@ -75,12 +79,43 @@ class OSMAlchemy(object):
                       …a string with a custom endpoint URL.
           maxage - optional; the maximum age after which elements are refreshed from
                    Overpass, in seconds, defaults to 86400s (1d)
+          fixed_point - optional; store coordinates as 32-bit integers in units of
+                        1e-7 degrees instead of decimals, defaults to False
+          overpass_cache - optional; path to a directory to store responses from
+                           Overpass in, for maxage seconds, defaults to None for
+                           no caching
+          negative_maxage - optional; time after which elements and areas not
+                            found on Overpass are asked for again, in seconds,
+                            defaults to 3600s (1h)
+          refresh_workers - optional; number of background threads refreshing
+                            expired elements from Overpass, which are served as
+                            they are meanwhile, defaults to 0 to refresh them
+                            before running the query; see stop_refresh; with
+                            Flask-SQLAlchemy, OSMAlchemy must be created with
+                            an application set or within an application
+                            context, which the threads then use
+          online_by_default - optional; whether queries in all sessions load data
+                              from Overpass, defaults to True; set to False to only
+                              go online in sessions with info["osmalchemy_online"]
+                              set to True, or set that to False in sessions that
+                              should only use the database
+          polymorphic - optional; how queries for elements load the data of
+                        nodes, ways and relations, can be…
+                         …"selectin" to load it with one more query per
+                          type found (the default), or…
+                         …None to load it lazily for each element, or…
+                         …"*" to join all their tables into every query
+          json_tags - optional; also store the tags of each element in a JSON
+                      column, so reading them does not need the tag tables,
+                      defaults to False; the tag tables are still used for
+                      querying by tags
         """
 
         # Create fields for SQLAlchemy stuff
         self.base = None
         self.engine = None
         self.session = None
+        self._app = None
 
         # Inspect sa argument
         if type(sa) is tuple:
@@ -99,6 +134,16 @@ class OSMAlchemy(object):
             self._engine = sa.engine
             self._base = sa.Model
             self._session = sa.session
+
+            # Application for sessions in background threads, if known
+            try:
+                self._app = sa.get_app()
+            except RuntimeError:
+                # Set up with init_app, outside of an application context
+                if refresh_workers:
+                    raise RuntimeError("Refreshing in the background needs the Flask "
+                                       "application; create OSMAlchemy within its "
+                                       "application context.")
         else:
             # Something was passed, but none of the expected argument types
             raise TypeError("Invalid argument passed to sa parameter.")
@@ -117,23 +162,158 @@ class OSMAlchemy(object):
             else:
                 # We got something unknown passed, bail out
                 raise TypeError("Invalid argument passed to overpass parameter.")
+
+            # Wrap API in a cache on disk if desired
+            if overpass_cache is not None:
+                self._overpass = _OverpassCache(self._overpass, overpass_cache, maxage)
         else:
             # Do not use overpass
             self._overpass = None
 
         # Generate model and store as instance members
-        self.node, self.way, self.relation, self.element = _generate_model(self._base,
-                                                                           self._prefix)
+        (self.node, self.way, self.relation, self.element,
+         self.tag, self.elements_tags, self.ways_nodes,
+         self.relations_elements) = _generate_model(self._base, self._prefix, fixed_point,
+                                                    polymorphic, json_tags)
 
         # Add triggers if online functionality is enabled
         if self._overpass is not None:
-            _generate_triggers(self, maxage)
+            self._refresh_queue, self._stop_refresh = _generate_triggers(
+                self, maxage, negative_maxage, refresh_workers,
+                online_by_default=online_by_default)
+        else:
+            self._refresh_queue, self._stop_refresh = None, None
 
-    def import_osm_file(self, path):
+    def import_osm_file(self, path, batch_size=10000, bulk=False, defer_indexes=False):
         """ Import data from an OSM XML file into this model.
 
           path - path to the file to import
+          batch_size - optional; number of elements to import per transaction,
+                       defaults to 10000, None imports everything in a single
+                       transaction
+          bulk - optional; write directly to the tables instead of using the ORM,
+                 much faster for large files, but must not run concurrently with
+                 other writers, defaults to False
+          defer_indexes - optional; drop indexes during the import and create
+                          them afterwards, for loading large files into
+                          mostly empty tables, defaults to False
         """
 
+        # Select utility function
+        if bulk:
+            importer = _bulk_import_osm_file
+        else:
+            importer = _import_osm_file
+
         # Call utility funtion with own reference and session
-        _import_osm_file(self, self._session, path)
+        if defer_indexes:
+            with _deferred_indexes(self, self._session):
+                importer(self, self._session, path, batch_size)
+        else:
+            importer(self, self._session, path, batch_size)
+
+    def with_tags(self):
+        """ Loader option loading the tags of queried elements.
+
+        Loads the tags of all elements of a query in one more query, e.g.:
+
+          session.query(osma.node).options(osma.with_tags())
+        """
+
+        return selectinload(getattr(self.element, self._prefix + "elements_tags")).joinedload(
+            self.elements_tags.tag)
+
+    def with_geometry(self):
+        """ Loader option loading the nodes of queried ways.
+
+        Loads the nodes of all ways of a query in one more query, e.g.:
+
+          session.query(osma.way).options(osma.with_geometry())
+        """
+
+        return selectinload(self.way._nodes).joinedload(self.ways_nodes.node)
+
+    def with_members(self):
+        """ Loader option loading the members of queried relations.
+
+        Loads the members of all relations of a query in one more query,
+        plus one per type of member unless polymorphic is "*", e.g.:
+
+          session.query(osma.relation).options(osma.with_members())
+        """
+
+        return selectinload(self.relation._members).joinedload(self.relations_elements.element)
+
+    def query_bbox(self, south, west, north, east, types=("node", "way")):
+        """ Get all elements in a bounding box, using the spatial index of nodes.
+
+          south, west, north, east - bounding box in degrees, south must not be
+                                     greater than north
+          types - optional; element types to return, any of "node", "way" and
+                  "relation", defaults to nodes and ways
+
+        Returns a tuple of (nodes, ways, relations) lists. Ways are those using
+        any of the nodes, relations those with any of the nodes or ways as member.
+        """
+
+        return _query_bbox(self, self._session, south, west, north, east, types)
+
+    def load_way_geometries(self, way_ids, as_numpy=False):
+        """ Get the node coordinates of many ways at once, without loading objects.
+
+          way_ids - OSM ids of the ways
+          as_numpy - optional; return NumPy arrays of shape (n, 2) instead of
+                     flat arrays of alternating latitudes and longitudes,
+                     defaults to False
+
+        Returns a dictionary mapping way ids to their coordinates in the order
+        of the nodes, leaving out ways that do not exist or have no nodes.
+        """
+
+        return _load_way_geometries(self, self._session, way_ids, as_numpy)
+
+    def resolve_relation(self, relation_id, depth=None):
+        """ Get all members of a relation and of its member relations at once.
+
+        Uses a recursive query, so nested relations are resolved without
+        walking them member by member; relations containing each other are
+        resolved only once.
+
+          relation_id - OSM id of the relation
+          depth - optional; maximum number of levels of relations to resolve,
+                  defaults to None for all levels
+
+        Returns a tuple of (relations, nodes, ways) dictionaries, mapping ids
+        of resolved relations to lists of (type, id, role) tuples of their
+        members, ids of member nodes to (latitude, longitude) tuples, and ids
+        of member ways to their coordinates as returned by load_way_geometries.
+        """
+
+        return _resolve_relation(self, self._session, relation_id, depth)
+
+    def stop_refresh(self, timeout=None):
+        """ Stop the threads refreshing expired elements in the background.
+
+        Elements already waiting are refreshed before the threads stop.
+        Afterwards, expired elements are refreshed before running queries.
+
+          timeout - optional; maximum time to wait for each thread, in seconds,
+                    defaults to None to wait until they are done
+        """
+
+        if self._stop_refresh is not None:
+            self._stop_refresh(timeout)
+
+    def replay_overpass_cache(self, expired=False):
+        """ Import all responses stored in the Overpass cache into this model.
+
+        Allows rebuilding the database without fetching data again.
+
+          expired - optional; whether to also import responses older than
+                    maxage, defaults to False
+        """
+
+        if not isinstance(self._overpass, _OverpassCache):
+            raise RuntimeError("No Overpass cache configured.")
+
+        self._overpass.replay(self, self._session, expired)
@@ -0,0 +1,241 @@
+# ~*~ coding: utf-8 ~*~
+#-
+# OSMAlchemy - OpenStreetMap to SQLAlchemy bridge
+# Copyright (c) 2016 Dominik George <nik@naturalnet.de>
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+#
+# Alternatively, you are free to use OSMAlchemy under Simplified BSD, The
+# MirOS Licence, GPL-2+, LGPL-2.1+, AGPL-3+ or the same terms as Python
+# itself.
+
+
+""" Efficient read access to OSMAlchemy models.
+
+The functions in this module answer common questions with a fixed
+number of queries, instead of walking relationships element by element.
+"""
+
+from array import array
+
+from sqlalchemy import and_, literal_column, or_, select, union
+try:
+    import numpy
+except ImportError:
+    # non-fatal, NumPy arrays are optional
+    numpy = None
+
+from .util import _chunks, _tile_ranges
+
+def _query_bbox(osma, session, south, west, north, east, types=("node", "way")):
+    """ Get all elements in a bounding box.
+
+    Not called directly; used by OSMAlchemy.query_bbox.
+
+      osma - reference to the OSMAlchemy model instance
+      session - an SQLAlchemy session
+      south, west, north, east - bounding box in degrees, west may be greater than
+                                 east for boxes crossing the antimeridian
+      types - element types to return, nodes inside the box, ways using these nodes
+              and relations with these nodes or ways as members
+
+    Returns a tuple of (nodes, ways, relations) lists, with lists for types not
+    requested left empty. Raises ValueError if south is greater than north.
+    """
+
+    if south > north:
+        raise ValueError("South of bounding box is north of its north.")
+
+    nodes_table = osma.node.__table__
+    ways_nodes = osma.ways_nodes.__table__
+    relations_elements = osma.relations_elements.__table__
+
+    # Split boxes crossing the antimeridian
+    if west > east:
+        boxes = [(south, west, north, 180.0), (south, -180.0, north, east)]
+        longitude = or_(nodes_table.c.longitude >= west, nodes_table.c.longitude <= east)
+    else:
+        boxes = [(south, west, north, east)]
+        longitude = nodes_table.c.longitude.between(west, east)
+
+    # Nodes are found using the tile index first, then filtered exactly
+    tiles = or_(*[nodes_table.c.tile.between(low, high)
+                  for box in boxes for low, high in _tile_ranges(*box)])
+    node_filter = and_(tiles, nodes_table.c.latitude.between(south, north), longitude)
+
+    # Subqueries for the element_ids of nodes and ways in the box
+    node_ids = select([nodes_table.c.element_id]).where(node_filter)
+    way_ids = select([ways_nodes.c.way_id]).where(ways_nodes.c.node_id.in_(node_ids))
+
+    nodes, ways, relations = [], [], []
+    if "node" in types:
+        nodes = session.query(osma.node).filter(osma.node.element_id.in_(node_ids)).all()
+    if "way" in types:
+        ways = session.query(osma.way).filter(osma.way.element_id.in_(way_ids)).all()
+    if "relation" in types:
+        relation_ids = select([relations_elements.c.relation_id]).where(
+            relations_elements.c.element_id.in_(union(node_ids, way_ids)))
+        relations = session.query(osma.relation).filter(
+            osma.relation.element_id.in_(relation_ids)).all()
+
+    return nodes, ways, relations
+
+def _collect_geometries(rows, geometries):
+    """ Collect rows of (way id, latitude, longitude) into arrays per way.
+
+    Rows of one way must be consecutive and in the order of its nodes.
+    """
+
+    nan = float("nan")
+    current, coordinates = None, None
+    for way_id, latitude, longitude in rows:
+        if way_id != current:
+            current, coordinates = way_id, array("d")
+            geometries[way_id] = coordinates
+        coordinates.append(nan if latitude is None else latitude)
+        coordinates.append(nan if longitude is None else longitude)
+
+def _load_way_geometries(osma, session, way_ids, as_numpy=False, chunk_size=500):
+    """ Get the coordinates of the nodes of many ways, without loading any objects.
+
+    Not called directly; used by OSMAlchemy.load_way_geometries.
+
+      osma - reference to the OSMAlchemy model instance
+      session - an SQLAlchemy session
+      way_ids - OSM ids of the ways
+      as_numpy - return NumPy arrays of shape (n, 2) instead of arrays
+      chunk_size - maximum number of ways per query
+
+    Returns a dictionary mapping way ids to arrays of alternating latitudes
+    and longitudes in the order of the nodes. Ways that do not exist or have
+    no nodes are left out. Nodes without coordinates are returned as NaN.
+    """
+
+    if as_numpy and numpy is None:
+        raise ImportError("NumPy is required for returning NumPy arrays.")
+
+    elements = osma.element.__table__
+    ways_nodes = osma.ways_nodes.__table__
+    nodes = osma.node.__table__
+
+    # Select coordinates of all nodes with the OSM id of their way, in order
+    joined = elements.join(ways_nodes, ways_nodes.c.way_id == elements.c.element_id).join(
+        nodes, nodes.c.element_id == ways_nodes.c.node_id)
+    q = select([elements.c.id, nodes.c.latitude, nodes.c.longitude]).select_from(joined)
+
+    geometries = {}
+    for chunk in _chunks(set(way_ids), chunk_size):
+        rows = session.execute(q.where(and_(elements.c.type == "way", elements.c.id.in_(chunk)))
+                               .order_by(elements.c.id, ways_nodes.c.position))
+        _collect_geometries(rows, geometries)
+
+    if as_numpy:
+        # Use arrays as buffers instead of copying
+        for way_id, coordinates in geometries.items():
+            geometries[way_id] = numpy.frombuffer(coordinates, dtype=numpy.float64).reshape(-1, 2)
+
+    return geometries
+
+def _resolve_relation(osma, session, relation_id, depth=None):
+    """ Get all members of a relation and its member relations, recursively.
+
+    Not called directly; used by OSMAlchemy.resolve_relation.
+
+    Relations to resolve are found with a recursive query, which stops at
+    relations already seen, so cycles are safe. It is run as part of two
+    queries, one for members and one for coordinates of member ways, so the
+    number of round trips does not depend on the size of the relation.
+
+      osma - reference to the OSMAlchemy model instance
+      session - an SQLAlchemy session
+      relation_id - OSM id of the relation
+      depth - maximum number of levels of relations to resolve, None for all
+
+    Returns a tuple of (relations, nodes, ways) dictionaries. relations maps
+    the ids of all resolved relations to lists of (type, id, role) tuples
+    of their members, in order. nodes maps ids of member nodes to tuples of
+    (latitude, longitude), ways maps ids of member ways to arrays of their
+    coordinates like OSMAlchemy.load_way_geometries.
+    """
+
+    elements = osma.element.__table__
+    relations_elements = osma.relations_elements.__table__
+    ways_nodes = osma.ways_nodes.__table__
+    nodes_table = osma.node.__table__
+
+    # Start with the relation itself, with its depth if limited
+    columns = [elements.c.element_id.label("element_id")]
+    if depth is not None:
+        columns.append(literal_column("1").label("depth"))
+    resolved = select(columns).where(
+        and_(elements.c.type == "relation", elements.c.id == relation_id)).cte(
+            "resolved", recursive=True)
+
+    # Add member relations of resolved relations; UNION drops rows already
+    # seen, which ends cycles, and the depth ends the recursion if limited
+    member = elements.alias("member")
+    columns = [relations_elements.c.element_id]
+    if depth is not None:
+        columns.append((resolved.c.depth + literal_column("1")).label("depth"))
+    step = select(columns).select_from(
+        resolved.join(relations_elements,
+                      relations_elements.c.relation_id == resolved.c.element_id).join(
+                          member, member.c.element_id == relations_elements.c.element_id)).where(
+                              member.c.type == "relation")
+    if depth is not None:
+        step = step.where(resolved.c.depth < depth)
+    resolved = resolved.union(step)
+    resolved_ids = select([resolved.c.element_id])
+
+    # Members of all resolved relations, with coordinates of member nodes;
+    # outer joins keep relations without members
+    relation = elements.alias("relation")
+    joined = relation.outerjoin(
+        relations_elements, relations_elements.c.relation_id == relation.c.element_id).outerjoin(
+            member, member.c.element_id == relations_elements.c.element_id).outerjoin(
+                nodes_table, nodes_table.c.element_id == relations_elements.c.element_id)
+    q = select([relation.c.id, member.c.type, member.c.id, relations_elements.c.role,
+                nodes_table.c.latitude, nodes_table.c.longitude]).select_from(joined).where(
+                    relation.c.element_id.in_(resolved_ids)).order_by(
+                        relation.c.element_id, relations_elements.c.position)
+
+    relations, nodes = {}, {}
+    for parent_id, type, id, role, latitude, longitude in session.execute(q):
+        members = relations.setdefault(parent_id, [])
+        if type is None:
+            continue
+        members.append((type, id, role))
+        if type == "node":
+            nodes[id] = (latitude, longitude)
+
+    # Coordinates of the nodes of member ways
+    way = elements.alias("way")
+    member_ways = select([relations_elements.c.element_id]).select_from(
+        relations_elements.join(member, member.c.element_id == relations_elements.c.element_id)).where(
+            and_(member.c.type == "way", relations_elements.c.relation_id.in_(resolved_ids)))
+    q = select([way.c.id, nodes_table.c.latitude, nodes_table.c.longitude]).select_from(
+        ways_nodes.join(way, way.c.element_id == ways_nodes.c.way_id).join(
+            nodes_table, nodes_table.c.element_id == ways_nodes.c.node_id)).where(
+                ways_nodes.c.way_id.in_(member_ways)).order_by(ways_nodes.c.way_id,
+                                                              ways_nodes.c.position)
+
+    ways = {}
+    _collect_geometries(session.execute(q), ways)
+
+    return relations, nodes, ways
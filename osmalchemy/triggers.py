@@ -28,49 +28,334 @@
 """ Trigger code for live OSMAlchemy/Overpass integration. """
 
 import datetime
-from sqlalchemy import inspect
+import logging
+import threading
+import time
+try:
+    from queue import Empty, Full, Queue
+except ImportError:
+    # Python 2
+    from Queue import Empty, Full, Queue
+from sqlalchemy import inspect, select
 from sqlalchemy.event import listens_for
 from sqlalchemy.orm import Query
 from weakref import WeakSet
 
-from .online import _get_single_element_by_id
-from .util import _analyse_clause, _import_osm_xml
+from .online import (_import_elements_by_id, _overpass_ids, _overpass_query, _OverpassCache,
+                     _SingleFlight)
+from .util import _analyse_clause, _chunks, _import_osm_xml, _LRUCache
 
-def _generate_triggers(osmalchemy, maxage=60*60*24):
+# Logger for errors in background threads
+_logger = logging.getLogger(__name__)
+
+def _plan_online_update(query, target, type, tree, maxage):
+    """ Find out which elements of a query need to be fetched online.
+
+    Runs the filter of the query once, only selecting type, id and update
+    time of the elements, and compares the result to the ids the query
+    asks for, if it is limited to ids. The query must not filter groups
+    with HAVING or select distinct expressions, which cannot be applied
+    to these columns.
+
+      query - the query to plan for
+      target - the model class queried
+      type - the Overpass element type of the model
+      tree - the analysed where clause of the query
+      maxage - maximum age of elements in seconds
+
+    Returns a tuple of (expired, missing, full), sets of (type, id) tuples
+    of expired and missing elements and whether the whole query needs to
+    be run, which is the case if it is not limited to ids and nothing
+    was found.
+    """
+
+    # Oldest update time that is still fresh
+    limit = datetime.datetime.now() - datetime.timedelta(seconds=maxage)
+
+    # Find elements the query reads from the database, ignoring ordering,
+    # grouping and limits, which would hide elements or not apply to the columns
+    projection = query.with_entities(target.type, target.id, target.osmalchemy_updated).limit(
+        None).offset(None).order_by(None).group_by(None)
+    found = set()
+    expired = set()
+    for element_type, id, updated in projection:
+        found.add(id)
+        if updated is None or updated < limit:
+            expired.add((element_type, id))
+
+    # Missing elements can only be told if the query asks for ids
+    ids = _overpass_ids(tree)
+    if ids is None:
+        return expired, set(), not found
+    else:
+        return expired, set((type, id) for id in ids - found), False
+
+def _stale_elements(session, table, elements, maxage):
+    """ Find elements that are missing or expired in the database.
+
+    Looks the elements up by id in the elements table, independent of
+    any query that asked for them. Elements of type "nwr" are fresh if
+    any element with their id is.
+
+      session - an SQLAlchemy session
+      table - the elements table
+      elements - set of (type, id) tuples to look up
+      maxage - maximum age of elements in seconds
+
+    Returns the set of (type, id) tuples of elements not stored or older
+    than maxage.
+    """
+
+    # Oldest update time that is still fresh
+    limit = datetime.datetime.now() - datetime.timedelta(seconds=maxage)
+
+    fresh = set()
+    for chunk in _chunks(set(id for type, id in elements)):
+        for type, id, updated in session.execute(select(
+                [table.c.type, table.c.id, table.c.osmalchemy_updated]).where(
+                    table.c.id.in_(chunk))):
+            if updated is not None and updated >= limit:
+                fresh.add((type, id))
+                fresh.add(("nwr", id))
+
+    return set(elements) - fresh
+
+def _generate_triggers(osmalchemy, maxage=60*60*24, negative_maxage=60*60, refresh_workers=0,
+                       refresh_batch_size=500, refresh_queue_size=10000, online_by_default=True):
     """ Generates the triggers for online functionality.
 
       osmalchemy - reference to the OSMAlchemy instance to be configured
       maxage - maximum age of objects before they are updated online, in seconds
+      negative_maxage - time in seconds to remember that elements or areas
+                        were not found online
+      refresh_workers - number of threads refreshing expired elements in the
+                        background while they are served stale, 0 to refresh
+                        them before running the query
+      refresh_batch_size - maximum number of elements refreshed at once
+      refresh_queue_size - maximum number of elements waiting for a refresh
+      online_by_default - whether queries go online in sessions that do not
+                          set "osmalchemy_online" in their info dictionary
+
+    Returns a tuple of the queue of elements waiting for a refresh and a
+    function stopping the refresh threads, both None if expired elements
+    are refreshed before running queries. Once the threads are stopped,
+    expired elements are refreshed before running queries as well.
     """
 
     _visited_queries = WeakSet()
 
-    @listens_for(Query, "before_compile")
-    def _query_compiling(query):
-        # Get the session associated with the query:
-        session = query.session
+    # Set while updating, so queries of the update do not trigger updates
+    _local = threading.local()
 
-        # Prevent recursion by skipping already-seen queries
-        if query in _visited_queries:
-            return
+    # Locks for queries being fetched, shared with other processes using the cache
+    if isinstance(osmalchemy._overpass, _OverpassCache):
+        flights = _SingleFlight(osmalchemy._overpass.directory)
+    else:
+        flights = _SingleFlight()
+
+    # Elements and queries not found online, mapped to the time to ask again
+    misses = _LRUCache()
+
+    # Overpass element types of the models
+    types = {osmalchemy.node: "node", osmalchemy.way: "way",
+             osmalchemy.relation: "relation", osmalchemy.element: "nwr"}
+
+    def _plan(query, target, tree, q):
+        # Plan update, leaving out what was recently not found online
+        expired, missing, full = _plan_online_update(query, target, types[target], tree, maxage)
+        now = time.time()
+        expired = set(e for e in expired if misses.get(e, 0) < now)
+        missing = set(e for e in missing if misses.get(e, 0) < now)
+        full = full and misses.get(q, 0) < now
+        return expired, missing, full
+
+    # Queue of expired elements to refresh in the background, and elements in it
+    if refresh_workers:
+        refresh_queue = Queue(refresh_queue_size)
+    else:
+        refresh_queue = None
+    queued = set()
+    queued_lock = threading.Lock()
+
+    # Set once the background refresh is stopped
+    stopped = threading.Event()
+
+    def _enqueue(elements):
+        with queued_lock:
+            for element in elements - queued:
+                try:
+                    refresh_queue.put_nowait(element)
+                except Full:
+                    # Left for a later query to queue again
+                    break
+                queued.add(element)
+
+    def _refresh(batch):
+        session = osmalchemy._session
+
+        # Fetch and import elements
+        _import_elements_by_id(osmalchemy, session, osmalchemy._overpass, batch)
+
+        # Remember elements that were not updated as not found online
+        until = time.time() + negative_maxage
+        for element in _stale_elements(session, osmalchemy.element.__table__, batch, maxage):
+            misses.put(element, until)
+
+    def _refresh_loop():
+        # Queries of the refresh must not trigger updates
+        _local.updating = True
+
+        while True:
+            # Wait for an element, None tells the worker to stop
+            element = refresh_queue.get()
+            if element is None:
+                refresh_queue.task_done()
+                return
+
+            # Take what else is waiting, leaving a stop for after the batch
+            batch = set([element])
+            taken = 1
+            while taken < refresh_batch_size:
+                try:
+                    element = refresh_queue.get_nowait()
+                except Empty:
+                    break
+                if element is None:
+                    refresh_queue.task_done()
+                    refresh_queue.put(None)
+                    break
+                batch.add(element)
+                taken += 1
+
+            try:
+                _refresh(batch)
+            except Exception:
+                # Elements stay expired and are queued again by later queries
+                _logger.exception("Refreshing elements from Overpass failed")
+            finally:
+                osmalchemy._session.remove()
+                with queued_lock:
+                    queued.difference_update(batch)
+                for i in range(taken):
+                    refresh_queue.task_done()
+
+    def _refresh_worker():
+        # Sessions of Flask-SQLAlchemy need an application context
+        if osmalchemy._app is not None:
+            with osmalchemy._app.app_context():
+                _refresh_loop()
         else:
-            _visited_queries.add(query)
+            _refresh_loop()
 
-        # Check whether this query affects our model
-        affected_models = set([c["type"] for c in query.column_descriptions])
-        our_models = set([osmalchemy.node, osmalchemy.way,  osmalchemy.relation,
-                          osmalchemy.element])
-        if affected_models.isdisjoint(our_models):
-            # None of our models is affected
+    workers = []
+    for i in range(refresh_workers):
+        worker = threading.Thread(target=_refresh_worker, name="osmalchemy-refresh-%d" % i)
+        worker.daemon = True
+        worker.start()
+        workers.append(worker)
+
+    def _stop_refresh(timeout=None):
+        # Let workers finish what is queued, then stop them
+        if stopped.is_set():
             return
+        stopped.set()
+        for worker in workers:
+            refresh_queue.put(None)
+        for worker in workers:
+            worker.join(timeout)
 
+    # Mappers of our models, to tell relevant queries by identity
+    mappers = dict((inspect(model), model) for model in types)
+
+    @listens_for(Query, "before_compile")
+    def _query_compiling(query):
         # Check whether this query filters elements
         # Online update will only run on a specified set, not all data
         if query.whereclause is None:
             # No filters
             return
 
-        # Analyse where clause looking for all looked-up fields
+        # Check whether this query affects our model; the private attributes
+        # of Query used here are those of SQLAlchemy 1.3, see setup.py
+        targets = set(mappers[entity.mapper] for entity in query._entities
+                      if getattr(entity, "mapper", None) in mappers)
+        if not targets:
+            # None of our models is affected
+            return
+
+        # Filters on groups or distinct expressions cannot be planned for
+        if query._having is not None or isinstance(query._distinct, list):
+            return
+
+        # Skip queries run by our own update
+        if getattr(_local, "updating", False):
+            return
+
+        # Get the session associated with the query, and check it is meant to go online
+        session = query.session
+        if session is None or not session.info.get("osmalchemy_online", online_by_default):
+            return
+
+        # Prevent recursion by skipping already-seen queries
+        if query in _visited_queries:
+            return
+        else:
+            _visited_queries.add(query)
+
+        # Analyse where clause looking for all looked-up fields; this is not
+        # cached by statement shape, as explained at _analyse_clause
         tree = {}
-        for target in our_models.intersection(affected_models):
-            tree[target.__name__] = _analyse_clause(query.whereclause, target)
+        for target in targets:
+            tree[target.__name__] = _analyse_clause(query.whereclause, target, osmalchemy.tag)
+
+            # Compile to an Overpass query selecting what the query will read
+            q = _overpass_query(tree[target.__name__], types[target])
+            if q is None:
+                continue
+
+            _local.updating = True
+            try:
+                # Find missing and expired elements
+                expired, missing, full = _plan(query, target, tree[target.__name__], q)
+
+                # Serve expired elements and refresh them in the background if enabled
+                background = refresh_queue is not None and not stopped.is_set()
+                if background:
+                    _enqueue(expired)
+                    expired = set()
+                if not expired and not missing and not full:
+                    continue
+
+                # Only one caller fetches the same query at a time
+                with flights.flight(q):
+                    # Plan again, another caller might have fetched the data meanwhile
+                    expired, missing, full = _plan(query, target, tree[target.__name__], q)
+                    if background:
+                        expired = set()
+                    elements = expired | missing
+                    if not elements and not full:
+                        continue
+
+                    # Run whole query or only fetch needed elements, then import results
+                    if full:
+                        _import_osm_xml(osmalchemy, session,
+                                        osmalchemy._overpass.Get(q, responseformat="xml"))
+                    else:
+                        _import_elements_by_id(osmalchemy, session, osmalchemy._overpass,
+                                               elements)
+
+                    # Remember elements and areas that were not found online
+                    # Elements are looked up by id, so the query cannot hide them
+                    until = time.time() + negative_maxage
+                    for element in _stale_elements(session, osmalchemy.element.__table__,
+                                                   elements, maxage):
+                        misses.put(element, until)
+                    if full and _plan_online_update(query, target, types[target],
+                                                    tree[target.__name__], maxage)[2]:
+                        misses.put(q, until)
+            finally:
+                _local.updating = False
+
+    if refresh_queue is None:
+        return None, None
+    return refresh_queue, _stop_refresh
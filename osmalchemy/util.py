@@ -27,176 +27,673 @@
 
 """ Utility code for OSMAlchemy. """
 
+import datetime
 import dateutil.parser
 import operator
-import xml.dom.minidom as minidom
-from sqlalchemy.sql.elements import BinaryExpression, BooleanClauseList, BindParameter
+import threading
+from collections import OrderedDict
+from io import BytesIO
+try:
+    # The C implementation is much faster on Python 2
+    import xml.etree.cElementTree as ElementTree
+except ImportError:
+    # Python 3 uses the C implementation automatically
+    import xml.etree.ElementTree as ElementTree
+from sqlalchemy import and_, bindparam, func, or_, select, union_all
+from sqlalchemy.dialects.postgresql import insert as postgresql_insert
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.sql import operators
+from sqlalchemy.sql.elements import (BinaryExpression, BooleanClauseList, BindParameter, ClauseList,
+                                     Grouping)
 from sqlalchemy.sql.annotation import AnnotatedColumn
+from sqlalchemy.orm.exc import NoResultFound
 
-def _import_osm_dom(osma, session, dom):
-    """ Import a DOM tree from OSM XML into an OSMAlchemy model.
+# Zoom level of the tile grid used for spatial indexing of nodes
+_TILE_ZOOM = 16
+
+def _tile_xy(latitude, longitude, zoom=_TILE_ZOOM):
+    """ Get the x and y numbers of the grid tile containing a coordinate.
+
+    The grid divides latitude and longitude into 2^zoom equal steps each.
+    """
+
+    n = 1 << zoom
+    x = min(int((longitude + 180.0) / 360.0 * n), n - 1)
+    y = min(int((latitude + 90.0) / 180.0 * n), n - 1)
+    return max(x, 0), max(y, 0)
+
+def _morton(x, y):
+    """ Interleave the bits of x and y into a Morton code (Z-order curve). """
+
+    code = 0
+    bit = 0
+    while x or y:
+        code |= (x & 1) << (2 * bit) | (y & 1) << (2 * bit + 1)
+        x >>= 1
+        y >>= 1
+        bit += 1
+    return code
+
+def _tile(latitude, longitude):
+    """ Get the Morton-coded grid tile of a coordinate, as stored with nodes. """
+
+    if latitude is None or longitude is None:
+        return None
+    return _morton(*_tile_xy(float(latitude), float(longitude)))
+
+def _tile_ranges(south, west, north, east, max_tiles=64):
+    """ Get ranges of tile codes covering a bounding box.
+
+    The box is covered with at most max_tiles tiles, as fine as possible.
+    Because of the Z-order curve, each tile on a coarser level covers a
+    contiguous range of tile codes on the finest level.
+
+    Returns a sorted list of inclusive (low, high) tuples.
+    """
+
+    # Find finest level with an acceptable number of tiles
+    for zoom in range(_TILE_ZOOM, -1, -1):
+        x0, y0 = _tile_xy(south, west, zoom)
+        x1, y1 = _tile_xy(north, east, zoom)
+        if (x1 - x0 + 1) * (y1 - y0 + 1) <= max_tiles:
+            break
+
+    # Convert tiles to ranges on the finest level
+    shift = 2 * (_TILE_ZOOM - zoom)
+    ranges = sorted((_morton(x, y) << shift, ((_morton(x, y) + 1) << shift) - 1)
+                    for x in range(x0, x1 + 1) for y in range(y0, y1 + 1))
+
+    # Merge adjacent ranges
+    merged = [ranges[0]]
+    for low, high in ranges[1:]:
+        if low == merged[-1][1] + 1:
+            merged[-1] = (merged[-1][0], high)
+        else:
+            merged.append((low, high))
+    return merged
+
+def _iterparse_osm(source):
+    """ Iterate over the elements of an OSM XML document while parsing it.
+
+    Yields every top-level <node>, <way> and <relation> element as soon as
+    it is complete and frees it afterwards, so memory usage does not depend
+    on the size of the document.
+
+      source - path to a file or open file object
+    """
+
+    # Keep track of the root element and the nesting depth
+    root = None
+    depth = 0
+
+    for event, e in ElementTree.iterparse(source, events=("start", "end")):
+        if event == "start":
+            if root is None:
+                # First element is the <osm> root
+                root = e
+            depth += 1
+        else:
+            depth -= 1
+            if depth == 1:
+                # Element is a direct child of the root and complete now
+                if e.tag in ("node", "way", "relation"):
+                    yield e
+
+                # Remove children from root to free memory
+                root.clear()
+
+def _xml_attrs(e):
+    """ Get the metadata attributes of an OSM XML element as a dictionary.
+
+    Only attributes present in the element are returned, converted to the
+    types used in the model.
+    """
+
+    attrs = {}
+    if "version" in e.attrib:
+        attrs["version"] = int(e.attrib["version"])
+    if "changeset" in e.attrib:
+        attrs["changeset"] = int(e.attrib["changeset"])
+    if "user" in e.attrib:
+        attrs["user"] = e.attrib["user"]
+    if "uid" in e.attrib:
+        attrs["uid"] = int(e.attrib["uid"])
+    if "visible" in e.attrib:
+        attrs["visible"] = True if e.attrib["visible"] == "true" else False
+    if "timestamp" in e.attrib:
+        attrs["timestamp"] = dateutil.parser.parse(e.attrib["timestamp"])
+    return attrs
+
+def _xml_tags(e):
+    """ Get the tags of an OSM XML element as a dictionary. """
+
+    # Target dictionary
+    tags = {}
+
+    # Iterate over all <tag /> nodes in the element
+    for t in e.iter("tag"):
+        # Append data to tags
+        tags[t.attrib["k"]] = t.attrib["v"]
+
+    return tags
+
+def _chunks(seq, size=500):
+    """ Split a sequence into lists of at most size items.
+
+    Used to keep IN clauses at a size all databases accept.
+    """
+
+    seq = list(seq)
+    for i in range(0, len(seq), size):
+        yield seq[i:i+size]
+
+def _update_bounds(conn, tables, node_ids=(), way_ids=(), relation_ids=(), max_depth=8):
+    """ Update the stored bounding boxes of ways and relations.
+
+    Ways using any of the given nodes and relations with any of the
+    changed elements as member are updated as well. Changes are propagated
+    to parent relations up to max_depth levels, which also stops cycles.
+
+      conn - the connection to run the statements on
+      tables - dictionary of the tables "node", "way", "relation", "ways_nodes"
+               and "relations_elements"
+      node_ids, way_ids, relation_ids - element_ids of changed elements
+
+    Returns a dictionary mapping ("way", element_id) or ("relation", element_id)
+    to (min_latitude, max_latitude, min_longitude, max_longitude).
+    """
+
+    nodes, ways, relations = tables["node"], tables["way"], tables["relation"]
+    ways_nodes, relations_elements = tables["ways_nodes"], tables["relations_elements"]
+
+    def _referencing(column, ref_column, ids):
+        # Find values of column in rows where ref_column is one of ids
+        found = set()
+        for chunk in _chunks(ids):
+            q = select([column]).where(ref_column.in_(chunk)).distinct()
+            found.update(row[0] for row in conn.execute(q))
+        return found
+
+    def _store(type, table, query, ids):
+        # Compute bounds with query, filtered by chunks of ids, and write them
+        rows = []
+        for chunk in _chunks(ids):
+            values = dict((row[0], tuple(row[1:])) for row in conn.execute(query(chunk)))
+            for element_id in chunk:
+                # Elements without any coordinates get no bounding box
+                value = values.get(element_id, (None, None, None, None))
+                bounds[(type, element_id)] = value
+                rows.append({"b_element_id": element_id,
+                             "min_latitude": value[0], "max_latitude": value[1],
+                             "min_longitude": value[2], "max_longitude": value[3]})
+        if rows:
+            conn.execute(table.update().where(table.c.element_id == bindparam("b_element_id")),
+                         rows)
+
+    def _way_bounds(chunk):
+        return select([ways_nodes.c.way_id,
+                       func.min(nodes.c.latitude), func.max(nodes.c.latitude),
+                       func.min(nodes.c.longitude), func.max(nodes.c.longitude)]).select_from(
+                           ways_nodes.join(nodes, nodes.c.element_id == ways_nodes.c.node_id)).where(
+                               ways_nodes.c.way_id.in_(chunk)).group_by(ways_nodes.c.way_id)
+
+    def _relation_bounds(chunk):
+        # Bounds of all members, nodes as points, ways and relations as boxes
+        members = union_all(
+            select([relations_elements.c.relation_id,
+                    nodes.c.latitude.label("min_latitude"), nodes.c.latitude.label("max_latitude"),
+                    nodes.c.longitude.label("min_longitude"),
+                    nodes.c.longitude.label("max_longitude")]).select_from(
+                        relations_elements.join(nodes, nodes.c.element_id ==
+                                                relations_elements.c.element_id)).where(
+                                                    relations_elements.c.relation_id.in_(chunk)),
+            *[select([relations_elements.c.relation_id,
+                      table.c.min_latitude, table.c.max_latitude,
+                      table.c.min_longitude, table.c.max_longitude]).select_from(
+                          relations_elements.join(table, table.c.element_id ==
+                                                  relations_elements.c.element_id)).where(
+                                                      relations_elements.c.relation_id.in_(chunk))
+              for table in (ways, relations)]).alias()
+        return select([members.c.relation_id,
+                       func.min(members.c.min_latitude), func.max(members.c.max_latitude),
+                       func.min(members.c.min_longitude),
+                       func.max(members.c.max_longitude)]).group_by(members.c.relation_id)
+
+    bounds = {}
+
+    # Update ways, including those using changed nodes
+    way_ids = set(way_ids) | _referencing(ways_nodes.c.way_id, ways_nodes.c.node_id, node_ids)
+    _store("way", ways, _way_bounds, way_ids)
+
+    # Update relations, including those with changed nodes or ways as member
+    relation_ids = set(relation_ids) | _referencing(relations_elements.c.relation_id,
+                                                    relations_elements.c.element_id,
+                                                    set(node_ids) | way_ids)
+    for depth in range(max_depth):
+        if not relation_ids:
+            break
+        _store("relation", relations, _relation_bounds, relation_ids)
+
+        # Continue with parent relations
+        relation_ids = _referencing(relations_elements.c.relation_id,
+                                    relations_elements.c.element_id, relation_ids)
+
+    return bounds
+
+def _batches(iterable, size):
+    """ Split an iterable into lists of at most size items.
+
+    A size of None puts all items into a single list.
+    """
+
+    batch = []
+    for item in iterable:
+        batch.append(item)
+        if size is not None and len(batch) >= size:
+            yield batch
+            batch = []
+
+    # Remaining items, also yields an empty batch for an empty iterable
+    if batch or size is None:
+        yield batch
+
+def _xml_refs(e):
+    """ Get the (type, id) tuples of all elements referenced by an OSM XML element. """
+
+    if e.tag == "way":
+        return [("node", int(n.attrib["ref"])) for n in e.iter("nd")]
+    elif e.tag == "relation":
+        return [(m.attrib["type"], int(m.attrib["ref"])) for m in e.iter("member")]
+    else:
+        return []
+
+class _IdMap(object):
+    """ Map of OSM ids to element_ids, used during imports.
+
+    Keeps a separate dictionary for each element type, so resolving a
+    reference is a single lookup instead of a query.
+    """
+
+    # Maximum number of values in one IN clause
+    chunk_size = 500
+
+    def __init__(self, elements):
+        """ Create an empty map.
+
+          elements - the table of OSMElement
+        """
+
+        self._elements = elements
+        self._ids = {"node": {}, "way": {}, "relation": {}}
+
+    def get(self, type, id):
+        """ Get the element_id of an element, None if it is not known. """
+
+        return self._ids[type].get(id)
+
+    def add(self, type, id, element_id):
+        """ Remember the element_id of an element. """
+
+        self._ids[type][id] = element_id
+
+    def prefetch(self, conn, keys):
+        """ Look up the element_ids of all unknown elements in the database.
+
+          conn - the connection to run the queries on
+          keys - iterable of (type, id) tuples
+        """
+
+        # Group unknown ids by type
+        missing = {}
+        for type, id in keys:
+            if id not in self._ids[type]:
+                missing.setdefault(type, set()).add(id)
+
+        # Query database in chunks of ids
+        for type, ids in missing.items():
+            for chunk in _chunks(ids, self.chunk_size):
+                q = select([self._elements.c.id, self._elements.c.element_id]).where(
+                    self._elements.c.type == type).where(self._elements.c.id.in_(chunk))
+                for id, element_id in conn.execute(q):
+                    self._ids[type][id] = element_id
+
+class _LRUCache(object):
+    """ Thread-safe dictionary holding only the most recently used items. """
+
+    def __init__(self, size=100000):
+        """ Create an empty cache.
+
+          size - maximum number of items to keep
+        """
+
+        self._size = size
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key, default=None):
+        """ Get an item and mark it as recently used. """
+
+        with self._lock:
+            if key not in self._data:
+                return default
+            value = self._data.pop(key)
+            self._data[key] = value
+            return value
+
+    def put(self, key, value):
+        """ Store an item, evicting the least recently used one if full. """
+
+        with self._lock:
+            self._data.pop(key, None)
+            self._data[key] = value
+            if len(self._data) > self._size:
+                self._data.popitem(last=False)
+
+    def discard(self, key):
+        """ Remove an item if it is stored. """
+
+        with self._lock:
+            self._data.pop(key, None)
+
+def _insert_ignore(conn, table, rows):
+    """ Insert rows, silently skipping rows that violate a unique constraint.
+
+    Safe against concurrent inserts of the same rows.
+
+      conn - the connection to run the statements on
+      table - the table to insert into
+      rows - list of dictionaries
+    """
+
+    if not rows:
+        return
+
+    if conn.dialect.name == "postgresql":
+        conn.execute(postgresql_insert(table).on_conflict_do_nothing(), rows)
+    elif conn.dialect.name == "sqlite":
+        conn.execute(table.insert().prefix_with("OR IGNORE"), rows)
+    elif conn.dialect.name == "mysql":
+        conn.execute(table.insert().prefix_with("IGNORE"), rows)
+    else:
+        # Generic fallback, one savepoint per row
+        for row in rows:
+            savepoint = conn.begin_nested()
+            try:
+                conn.execute(table.insert(), row)
+                savepoint.commit()
+            except IntegrityError:
+                savepoint.rollback()
+
+def _intern_tags(conn, table, pairs, cache=None):
+    """ Get the tag_ids for (key, value) pairs, creating missing tags.
+
+    Every pair is stored only once in the tags table. Concurrent
+    imports creating the same tag are safe; on MySQL, created tags are
+    looked up with a locking read, which sees tags committed by other
+    transactions that a plain read in REPEATABLE READ isolation would not.
+
+      conn - the connection to run the statements on
+      table - the table of OSMTag
+      pairs - iterable of (key, value) tuples
+      cache - optional _LRUCache mapping (key, value) to tag_id
+
+    Returns a dictionary mapping (key, value) to tag_id.
+    """
+
+    # Number of pairs to look up per query
+    chunk_size = 100
+
+    def _select(pairs, locking=False):
+        found = {}
+        for i in range(0, len(pairs), chunk_size):
+            q = select([table.c.tag_id, table.c.key, table.c.value]).where(
+                or_(*[and_(table.c.key == key, table.c.value == value)
+                      for key, value in pairs[i:i+chunk_size]]))
+            if locking:
+                q = q.with_for_update(read=True)
+            for tag_id, key, value in conn.execute(q):
+                found[(key, value)] = tag_id
+        return found
+
+    # Try the cache first
+    tag_ids = {}
+    missing = []
+    for pair in set(pairs):
+        tag_id = cache.get(pair) if cache is not None else None
+        if tag_id is None:
+            missing.append(pair)
+        else:
+            tag_ids[pair] = tag_id
+
+    if missing:
+        # Look up existing tags, then create the others and look them up as well
+        found = _select(missing)
+        created = [pair for pair in missing if pair not in found]
+        if created:
+            _insert_ignore(conn, table, [{"key": key, "value": value} for key, value in created])
+            found.update(_select(created, locking=conn.dialect.name == "mysql"))
+
+        tag_ids.update(found)
+        if cache is not None:
+            for pair, tag_id in found.items():
+                cache.put(pair, tag_id)
+
+    return tag_ids
+
+def _import_osm_elements(osma, session, elements, batch_size=10000):
+    """ Import OSM XML elements into an OSMAlchemy model.
 
     Not called directly; used by _import_osm_xml and _import_osm_file.
+
+      osma - reference to the OSMAlchemy model instance
+      session - an SQLAlchemy session
+      elements - iterable of ElementTree elements, as returned by _iterparse_osm
+      batch_size - number of elements to import per transaction, None to
+                   import everything in a single transaction
     """
 
-    def _dom_attrs_to_any(e, element):
-        if "version" in e.attributes.keys():
-            element.version = int(e.attributes["version"].value)
-        if "changeset" in e.attributes.keys():
-            element.changeset = int(e.attributes["changeset"].value)
-        if "user" in e.attributes.keys():
-            element.user = e.attributes["user"].value
-        if "uid" in e.attributes.keys():
-            element.uid = int(e.attributes["uid"].value)
-        if "visible" in e.attributes.keys():
-            element.visible = True if e.attributes["visible"].value == "true" else False
-        if "timestamp" in e.attributes.keys():
-            element.timestamp = dateutil.parser.parse(e.attributes["timestamp"].value)
-
-    def _dom_tags_to_any(e, element):
-        # Target dictionary
-        tags = {}
-
-        # Iterate over all <tag /> nodes in the DOM element
-        for t in e.getElementsByTagName("tag"):
-            # Append data to tags
-            tags[t.attributes["k"].value] = t.attributes["v"].value
-
-        # Store tags dictionary in object
-        element.tags = tags
-
-    def _dom_to_node(e):
+    # Map element types to model classes
+    classes = {"node": osma.node, "way": osma.way, "relation": osma.relation}
+
+    # Map of OSM ids to element_ids of all elements known to the import
+    ids = _IdMap(osma.element.__table__)
+
+    # Elements added to the session in the current transaction, by (type, id)
+    # Needed because they are not flushed and thus have no element_id yet
+    pending = {}
+
+    def _prefetch(batch):
+        # Resolve all elements of the batch and their references at once
+        keys = set((e.tag, int(e.attrib["id"])) for e in batch)
+        refs = set()
+        for e in batch:
+            refs.update(_xml_refs(e))
+        ids.prefetch(session.connection(), keys | refs)
+
+        # Load existing elements of the batch, one query per type
+        existing = {}
+        for type, id in keys:
+            element_id = ids.get(type, id)
+            if element_id is not None:
+                existing.setdefault(type, []).append(element_id)
+        for type, element_ids in existing.items():
+            for i in range(0, len(element_ids), _IdMap.chunk_size):
+                chunk = element_ids[i:i+_IdMap.chunk_size]
+                for element in session.query(classes[type]).filter(
+                        classes[type].element_id.in_(chunk)):
+                    pending[(type, element.id)] = element
+
+    def _find_element(type, id):
+        # Only elements of the current batch are loaded as objects
+        return pending.get((type, id))
+
+    def _add_element(type, element):
+        # Add to session and remember until the next commit
+        session.add(element)
+        pending[(type, element.id)] = element
+
+    def _xml_attrs_to_any(e, element):
+        for name, value in _xml_attrs(e).items():
+            setattr(element, name, value)
+
+        # Mark as updated even if nothing changed
+        element.osmalchemy_updated = datetime.datetime.now()
+
+    def _xml_tags_to_any(e, element):
+        element.tags = _xml_tags(e)
+
+    def _xml_to_node(e):
         with session.no_autoflush:
             # Get mandatory node id
-            id = int(e.attributes["id"].value)
+            id = int(e.attrib["id"])
 
-            # Find object in database and create if non-existent
-            node = session.query(osma.node).filter_by(id=id).scalar()
+            # Find object in batch and create if non-existent
+            node = _find_element("node", id)
             if node is None:
                 node = osma.node(id=id)
 
             # Store mandatory latitude and longitude
-            node.latitude = e.attributes["lat"].value
-            node.longitude = e.attributes["lon"].value
+            node.latitude = float(e.attrib["lat"])
+            node.longitude = float(e.attrib["lon"])
 
             # Store other attributes and tags
-            _dom_attrs_to_any(e, node)
-            _dom_tags_to_any(e, node)
+            _xml_attrs_to_any(e, node)
+            _xml_tags_to_any(e, node)
 
         # Add to session
-        session.add(node)
-        session.commit()
+        _add_element("node", node)
 
-    def _dom_to_way(e):
+    def _xml_to_way(e):
         with session.no_autoflush:
             # Get mandatory way id
-            id = int(e.attributes["id"].value)
+            id = int(e.attrib["id"])
 
-            # Find object in database and create if non-existent
-            way = session.query(osma.way).filter_by(id=id).scalar()
+            # Find object in batch and create if non-existent
+            way = _find_element("way", id)
             if way is None:
                 way = osma.way(id=id)
 
             # Find all related nodes
-            for n in e.getElementsByTagName("nd"):
-                # Get node id and find object
-                ref = int(n.attributes["ref"].value)
-                node = session.query(osma.node).filter_by(id=ref).one()
-                # Append to nodes in way
-                way.nodes.append(node)
+            nodes = []
+            for n in e.iter("nd"):
+                ref = int(n.attrib["ref"])
+
+                # Use object of current batch or map to element_id, without loading it
+                node = _find_element("node", ref)
+                node_id = ids.get("node", ref)
+                if node is not None:
+                    nodes.append(osma.ways_nodes(node=node))
+                elif node_id is not None:
+                    nodes.append(osma.ways_nodes(node_id=node_id))
+                else:
+                    raise NoResultFound("Node %d referenced by way %d not found." % (ref, id))
+
+            # Replace nodes of way
+            way._nodes = nodes
 
             # Store other attributes and tags
-            _dom_attrs_to_any(e, way)
-            _dom_tags_to_any(e, way)
+            _xml_attrs_to_any(e, way)
+            _xml_tags_to_any(e, way)
 
         # Add to session
-        session.add(way)
-        session.commit()
+        _add_element("way", way)
 
-    def _dom_to_relation(e):
+    def _xml_to_relation(e):
         with session.no_autoflush:
             # Get mandatory way id
-            id = int(e.attributes["id"].value)
+            id = int(e.attrib["id"])
 
-            # Find object in database and create if non-existent
-            relation = session.query(osma.relation).filter_by(id=id).scalar()
+            # Find object in batch and create if non-existent
+            relation = _find_element("relation", id)
             if relation is None:
                 relation = osma.relation(id=id)
 
+                # Register early, as the relation may be its own member
+                _add_element("relation", relation)
+
             # Find all members
-            for m in e.getElementsByTagName("member"):
+            members = []
+            for m in e.iter("member"):
                 # Get member attributes
-                ref = int(m.attributes["ref"].value)
-                type = m.attributes["type"].value
+                ref = int(m.attrib["ref"])
+                type = m.attrib["type"]
 
-                if "role" in m.attributes.keys():
-                    role = m.attributes["role"].value
+                if "role" in m.attrib:
+                    role = m.attrib["role"]
                 else:
                     role = ""
-                element = session.query(osma.element).filter_by(id=ref, type=type).scalar()
-                if element is None:
-                    # We do not know the member yet, create a stub
-                    if type == "node":
-                        element = osma.node(id=ref)
-                    elif type == "way":
-                        element = osma.way(id=ref)
-                    elif type == "relation":
-                        element = osma.relation(id=ref)
-                    # We need to commit here because element could be repeated
-                    session.add(element)
-                    session.commit()
-                # Append to members
-                relation.members.append((element, role))
+
+                # Use object of current batch or map to element_id, without loading it
+                element = _find_element(type, ref)
+                element_id = ids.get(type, ref)
+                if element is None and element_id is not None:
+                    members.append(osma.relations_elements(element_id=element_id, role=role))
+                else:
+                    if element is None:
+                        # We do not know the member yet, create a stub
+                        # It is remembered as pending in case it is repeated
+                        element = classes[type](id=ref)
+                        _add_element(type, element)
+                    members.append(osma.relations_elements(element=element, role=role))
+
+            # Replace members of relation
+            relation._members = members
 
             # Store other attributes and tags
-            _dom_attrs_to_any(e, relation)
-            _dom_tags_to_any(e, relation)
+            _xml_attrs_to_any(e, relation)
+            _xml_tags_to_any(e, relation)
 
         # Add to session
-        session.add(relation)
-        session.commit()
+        _add_element("relation", relation)
 
-    # Get root element
-    osm = dom.documentElement
+    # Import elements in batches, one transaction each
+    for batch in _batches(elements, batch_size):
+        _prefetch(batch)
 
-    # Iterate over children to find nodes, ways and relations
-    for e in osm.childNodes:
         # Determine element type
-        if e.nodeName == "node":
-            _dom_to_node(e)
-        elif e.nodeName == "way":
-            _dom_to_way(e)
-        elif e.nodeName == "relation":
-            _dom_to_relation(e)
+        for e in batch:
+            if e.tag == "node":
+                _xml_to_node(e)
+            elif e.tag == "way":
+                _xml_to_way(e)
+            elif e.tag == "relation":
+                _xml_to_relation(e)
+
+        # Remember element_ids assigned by the database before they expire on commit
+        session.flush()
+        for (type, id), element in pending.items():
+            ids.add(type, id, element.element_id)
+        pending.clear()
 
-        # Rmove children
-        e.unlink()
+        session.commit()
 
-def _import_osm_xml(osma, session, xml):
+def _import_osm_xml(osma, session, xml, batch_size=10000):
     """ Import a string in OSM XML format into an OSMAlchemy model.
 
       osma - reference to the OSMAlchemy model instance
       session - an SQLAlchemy session
       xml - string containing the XML data
+      batch_size - number of elements to import per transaction, None for one transaction
     """
 
-    # Parse string into DOM structure
-    dom = minidom.parseString(xml)
+    # The parser expects encoded data
+    if not isinstance(xml, bytes):
+        xml = xml.encode("utf-8")
 
-    return _import_osm_dom(osma, session, dom)
+    # Parse string incrementally and import elements
+    return _import_osm_elements(osma, session, _iterparse_osm(BytesIO(xml)), batch_size)
 
-def _import_osm_file(osma, session, file):
+def _import_osm_file(osma, session, file, batch_size=10000):
     """ Import a file in OSM XML format into an OSMAlchemy model.
 
       osma - reference to the OSMAlchemy model instance
       session - an SQLAlchemy session
       path - path to the file to import or open file object
+      batch_size - number of elements to import per transaction, None for one transaction
     """
 
-    # Parse document into DOM structure
-    dom = minidom.parse(file)
-
-    return _import_osm_dom(osma, session, dom)
+    # Parse document incrementally and import elements
+    return _import_osm_elements(osma, session, _iterparse_osm(file), batch_size)
 
 # Define operator to string mapping
 _ops = {operator.eq: "==",
@@ -206,9 +703,39 @@ _ops = {operator.eq: "==",
         operator.le: "<=",
         operator.ge: ">=",
         operator.and_: "&&",
-        operator.or_: "||"}
+        operator.or_: "||",
+        operators.in_op: "in",
+        operators.like_op: "like",
+        operators.ilike_op: "ilike"}
+
+def _analyse_clause(clause, target, tag=None):
+    """ Analyse a where clause into a tree in polish notation.
+
+    Returns (op, field, value) tuples for comparisons and (op, [clauses])
+    tuples for && and || operations, or None if the clause is not supported.
+
+      clause - the where clause of a query
+      target - the model class to look for fields of
+      tag - optional; the tag model class, its fields are returned as
+            "tag.key" and "tag.value"
+
+    Results are not cached. SQLAlchemy 1.3 has no cache key for clauses,
+    and computing a structural key walks the same tree, so it costs about
+    as much as the analysis itself.
+    """
+
+    if clause is None:
+        return None
+
+    # Tag filters created by has_tag of the models are marked as such
+    tag_filter = clause._annotations.get("osmalchemy_tag")
+    if tag_filter is not None:
+        model, key, value = tag_filter
+        if model is target:
+            return ("has", "tags", (key, value))
+        else:
+            return None
 
-def _analyse_clause(clause, target):
     if type(clause) is BinaryExpression:
         # This is something like "latitude >= 51.0"
         left = clause.left
@@ -225,6 +752,9 @@ def _analyse_clause(clause, target):
             if model is target:
                 # Store field name
                 left = field.name
+            elif tag is not None and model is tag:
+                # Store field name of joined tags
+                left = "tag." + field.name
             else:
                 return None
         else:
@@ -235,6 +765,16 @@ def _analyse_clause(clause, target):
         if type(right) is BindParameter:
             # Extract literal value
             right = right.value
+        elif op is operators.in_op and type(right) is Grouping and \
+             type(right.element) is ClauseList and \
+             all(type(c) is BindParameter for c in right.element.clauses):
+            # This is something like "id IN (1, 2)", extract list of literal values
+            right = [c.value for c in right.element.clauses]
+        elif op is operators.between_op and type(right) is ClauseList and \
+             len(right.clauses) == 2 and all(type(c) is BindParameter for c in right.clauses):
+            # This is something like "latitude BETWEEN 50.0 AND 51.0", return as range
+            lower, upper = [c.value for c in right.clauses]
+            return ("&&", [(">=", left, lower), ("<=", left, upper)])
         else:
             # Right now, we cannot cope with something else here
             return None
@@ -257,11 +797,15 @@ def _analyse_clause(clause, target):
         # Iterate over all the clauses in this operation
         for clause in clause.clauses:
             # Recursively analyse clauses
-            res = _analyse_clause(clause, target)
+            res = _analyse_clause(clause, target, tag)
             # None is returned for unsupported clauses or operations
             if res is not None:
                 # Append polish notation result to clauses list
                 clauses.append(res)
+            elif op is operator.or_:
+                # Leaving out an alternative would narrow the selection,
+                # so the whole OR is unsupported
+                return None
 
         # Look for a known operator
         if op in _ops.keys():
@@ -273,6 +817,9 @@ def _analyse_clause(clause, target):
 
         # Return polish notation tuple of this clause
         return (op, clauses)
+    elif type(clause) is Grouping:
+        # Parentheses around a nested operation
+        return _analyse_clause(clause.element, target, tag)
     else:
         # We hit an unsupported type of clause
         return None
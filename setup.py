@@ -46,12 +46,12 @@ setup(
     # Distribution information
     zip_safe = True,
     install_requires = [
-                        'SQLAlchemy>=1.0.0',
+                        'SQLAlchemy>=1.3.0,<1.4',
                         'python-dateutil',
                         'overpass'
                        ],
     tests_require = [
-                     'SQLAlchemy>=1.0.0',
+                     'SQLAlchemy>=1.3.0,<1.4',
                      'python-dateutil',
                      'overpass',
                      'psycopg2',
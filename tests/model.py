@@ -42,7 +42,7 @@ from testing.postgresql import PostgresqlFactory
 from osmalchemy import OSMAlchemy
 
 # SQLAlchemy for working with model and data
-from sqlalchemy import create_engine
+from sqlalchemy import create_engine, event
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.orm import sessionmaker, scoped_session
 
@@ -312,6 +312,257 @@ class OSMAlchemyModelTests(object):
         self.assertEqual(relation.members[7][0].tags[u"bang"], u"baz")
         self.assertEqual(relation.members[8][0].tags, relation.members[3][0].nodes[0].tags)
 
+    def test_has_tag(self):
+        # Create nodes and a way with some tags
+        node1 = self.osmalchemy.node(51.0, 7.0)
+        node1.tags = {u"highway": u"bus_stop", u"name": u"Eins"}
+        node2 = self.osmalchemy.node(51.1, 7.1)
+        node2.tags = {u"highway": u"platform"}
+        way = self.osmalchemy.way()
+        way.nodes = [node1, node2]
+        way.tags = {u"highway": u"bus_stop"}
+
+        # Store everything
+        self.session.add_all([node1, node2, way])
+        self.session.commit()
+        # Ensure removal from ORM
+        self.session.remove()
+
+        # Query nodes by tags
+        node = self.osmalchemy.node
+        self.assertEqual(self.session.query(node).filter(node.has_tag(u"highway")).count(), 2)
+        self.assertEqual(self.session.query(node).filter(
+            node.has_tag(u"highway", u"bus_stop")).one().tags[u"name"], u"Eins")
+        self.assertEqual(self.session.query(node).filter(
+            node.has_tag(u"highway", u"bus_stop"), node.has_tag(u"name")).count(), 1)
+        self.assertEqual(self.session.query(node).filter(
+            node.has_tag(u"name", u"Zwei")).count(), 0)
+
+    def test_polymorphic_loading(self):
+        # Create elements of all types
+        node = self.osmalchemy.node(51.0, 7.0)
+        node.id = 1
+        way = self.osmalchemy.way()
+        way.id = 1
+        way.nodes = [node]
+        relation = self.osmalchemy.relation()
+        relation.id = 1
+        relation.members = [(way, u"outer")]
+
+        # Store everything
+        self.session.add_all([node, way, relation])
+        self.session.commit()
+        # Ensure removal from ORM
+        self.session.remove()
+
+        # Query elements without joining the tables of the types
+        query = self.session.query(self.osmalchemy.element).filter_by(id=1)
+        self.assertNotIn("JOIN", str(query))
+        elements = dict((element.type, element) for element in query)
+        self.assertEqual(elements["node"].latitude, 51.0)
+        self.assertEqual(elements["way"].nodes[0].longitude, 7.0)
+        self.assertEqual(elements["relation"].members[0][1], u"outer")
+
+    def test_polymorphic_options(self):
+        # Joining all tables and lazy loading are available as well
+        engine = create_engine("sqlite:///:memory:")
+        osmalchemy = OSMAlchemy((engine, declarative_base(bind=engine)), polymorphic="*")
+        self.assertIn("JOIN", str(self.session.query(osmalchemy.element)))
+        osmalchemy = OSMAlchemy((engine, declarative_base(bind=engine)), polymorphic=None)
+        self.assertNotIn("JOIN", str(self.session.query(osmalchemy.element)))
+
+        # Unknown strategies are refused
+        with self.assertRaises(ValueError):
+            OSMAlchemy((engine, declarative_base(bind=engine)), polymorphic="joined")
+
+    def test_loader_presets(self):
+        # Create ways with tagged nodes, and a relation of them
+        relation = self.osmalchemy.relation()
+        for i in range(3):
+            node1 = self.osmalchemy.node(51.0, 7.0 + i)
+            node1.tags = {u"name": u"Eins"}
+            node2 = self.osmalchemy.node(51.1, 7.0 + i)
+            way = self.osmalchemy.way()
+            way.nodes = [node1, node2]
+            way.tags = {u"highway": u"residential"}
+            relation.members.append((way, u"outer"))
+            relation.members.append((node2, u"stop"))
+
+        # Store everything
+        self.session.add(relation)
+        self.session.commit()
+        # Ensure removal from ORM
+        self.session.remove()
+
+        # Count statements run while loading
+        statements = []
+        def _count(conn, cursor, statement, parameters, context, executemany):
+            statements.append(statement)
+        event.listen(self.osmalchemy._engine, "before_cursor_execute", _count)
+        try:
+            # Ways with tags and nodes
+            ways = self.session.query(self.osmalchemy.way).options(
+                self.osmalchemy.with_tags(), self.osmalchemy.with_geometry()).all()
+            self.assertEqual([way.tags[u"highway"] for way in ways], [u"residential"] * 3)
+            self.assertEqual(sorted(way.nodes[0].longitude for way in ways), [7.0, 8.0, 9.0])
+            self.assertEqual(len(statements), 3)
+            self.session.remove()
+
+            # Relations with members
+            del statements[:]
+            relation = self.session.query(self.osmalchemy.relation).options(
+                self.osmalchemy.with_members()).one()
+            self.assertEqual([(element.type, role) for element, role in relation.members],
+                             [(u"way", u"outer"), (u"node", u"stop")] * 3)
+            self.assertEqual(relation.members[1][0].latitude, 51.1)
+            self.assertEqual(len(statements), 4)
+
+            # Nodes with tags
+            del statements[:]
+            nodes = self.session.query(self.osmalchemy.node).options(
+                self.osmalchemy.with_tags()).all()
+            self.assertEqual(sum(len(node.tags) for node in nodes), 3)
+            self.assertEqual(len(statements), 2)
+        finally:
+            event.remove(self.osmalchemy._engine, "before_cursor_execute", _count)
+
+    def test_json_tags(self):
+        # Use a model storing tags as JSON as well
+        osmalchemy = OSMAlchemy((self.osmalchemy._engine, declarative_base(), self.session),
+                                prefix="json_", json_tags=True)
+        osmalchemy._base.metadata.create_all(self.osmalchemy._engine)
+
+        # Create nodes with tags, and change them in place
+        node1 = osmalchemy.node(51.0, 7.0)
+        node1.tags = {u"highway": u"bus_stop", u"name": u"Eins"}
+        node1.tags[u"name"] = u"Zwei"
+        node1.tags.update({u"shelter": u"yes"})
+        node2 = osmalchemy.node(51.1, 7.1)
+        node2.tags = {u"highway": u"bus_stop", u"bench": u"no"}
+        del node2.tags[u"bench"]
+
+        # Store nodes
+        self.session.add_all([node1, node2])
+        self.session.commit()
+        # Ensure removal from ORM
+        self.session.remove()
+
+        # Tags are read from the JSON column and from the tag tables alike
+        node = self.session.query(osmalchemy.node).filter_by(latitude=51.0).one()
+        self.assertEqual(node.tags_json, {u"highway": u"bus_stop", u"name": u"Zwei",
+                                          u"shelter": u"yes"})
+        self.assertEqual(node.tags, dict(node._tags))
+        self.assertEqual(self.session.query(osmalchemy.node).filter(
+            osmalchemy.node.has_tag(u"highway", u"bus_stop")).count(), 2)
+        self.assertEqual(self.session.query(osmalchemy.node).filter(
+            osmalchemy.node.has_tag(u"bench")).count(), 0)
+
+        # Removing tags changes both
+        node.tags.pop(u"shelter")
+        self.session.commit()
+        self.session.remove()
+        node = self.session.query(osmalchemy.node).filter_by(latitude=51.0).one()
+        self.assertEqual(node.tags, {u"highway": u"bus_stop", u"name": u"Zwei"})
+        self.assertEqual(dict(node._tags), {u"highway": u"bus_stop", u"name": u"Zwei"})
+
+    def test_flush_listeners_shared(self):
+        # Further models do not add listeners to all sessions
+        def _listeners():
+            session = sessionmaker()()
+            return (len(session.dispatch.before_flush), len(session.dispatch.after_flush),
+                    len(session.dispatch.after_flush_postexec))
+        count = _listeners()
+        engine = create_engine("sqlite:///:memory:")
+        OSMAlchemy((engine, declarative_base(bind=engine)), prefix="other_")
+        self.assertEqual(_listeners(), count)
+
+    def test_tags_are_shared(self):
+        # Create nodes with equal tags
+        node1 = self.osmalchemy.node(51.0, 7.0)
+        node1.tags = {u"highway": u"bus_stop", u"name": u"Eins"}
+        node2 = self.osmalchemy.node(51.1, 7.1)
+        node2.tags = {u"highway": u"bus_stop", u"name": u"Zwei"}
+
+        # Store everything
+        self.session.add_all([node1, node2])
+        self.session.commit()
+
+        # Add another node with an already stored tag
+        node3 = self.osmalchemy.node(51.2, 7.2)
+        node3.tags = {u"highway": u"bus_stop"}
+        self.session.add(node3)
+        self.session.commit()
+
+        # Change tag on one node
+        node1.tags[u"highway"] = u"platform"
+        self.session.commit()
+        # Ensure removal from ORM
+        self.session.remove()
+
+        # Check that tags were only stored once
+        self.assertEqual(self.session.query(self.osmalchemy.tag).filter_by(
+            key=u"highway", value=u"bus_stop").count(), 1)
+        self.assertEqual(self.session.query(self.osmalchemy.tag).count(), 4)
+
+        # Check that changing the tag did not affect the other nodes
+        nodes = self.session.query(self.osmalchemy.node).order_by(
+            self.osmalchemy.node.latitude).all()
+        self.assertEqual(nodes[0].tags, {u"highway": u"platform", u"name": u"Eins"})
+        self.assertEqual(nodes[1].tags, {u"highway": u"bus_stop", u"name": u"Zwei"})
+        self.assertEqual(nodes[2].tags, {u"highway": u"bus_stop"})
+
+    def test_tags_added_directly(self):
+        # Add a tag on its own, twice
+        tag1 = self.osmalchemy.tag(u"highway", u"bus_stop")
+        self.session.add(tag1)
+        self.session.commit()
+        tag2 = self.osmalchemy.tag(u"highway", u"bus_stop")
+        self.session.add(tag2)
+        self.session.commit()
+
+        # Check that both carry the id of the single stored tag
+        stored = self.session.query(self.osmalchemy.tag).one()
+        self.assertEqual(tag1.tag_id, stored.tag_id)
+        self.assertEqual(tag2.tag_id, stored.tag_id)
+
+    def test_bounds_of_ways_and_relations(self):
+        # Create relation with a way and a node
+        way = self.osmalchemy.way()
+        way.nodes = [self.osmalchemy.node(51.0, 7.0),
+                     self.osmalchemy.node(51.2, 7.4),
+                     self.osmalchemy.node(51.1, 7.2)]
+        relation = self.osmalchemy.relation()
+        relation.members = [(way, u"outer"), (self.osmalchemy.node(50.5, 7.3), u"")]
+
+        # Store everything
+        self.session.add(relation)
+        self.session.commit()
+
+        # Check bounds
+        self.assertEqual((way.min_latitude, way.max_latitude, way.min_longitude,
+                          way.max_longitude), (51.0, 51.2, 7.0, 7.4))
+        self.assertEqual((relation.min_latitude, relation.max_latitude, relation.min_longitude,
+                          relation.max_longitude), (50.5, 51.2, 7.0, 7.4))
+
+        # Move a node of the way and check bounds again
+        way.nodes[1].latitude = 51.5
+        self.session.commit()
+        # Ensure removal from ORM
+        self.session.remove()
+
+        way = self.session.query(self.osmalchemy.way).one()
+        relation = self.session.query(self.osmalchemy.relation).one()
+        self.assertEqual(way.max_latitude, 51.5)
+        self.assertEqual(relation.max_latitude, 51.5)
+
+        # Filter by bounding box
+        self.assertEqual(self.session.query(self.osmalchemy.way).filter(
+            self.osmalchemy.way.intersects_bbox(51.4, 7.3, 52.0, 8.0)).count(), 1)
+        self.assertEqual(self.session.query(self.osmalchemy.way).filter(
+            self.osmalchemy.way.intersects_bbox(50.0, 7.3, 50.9, 8.0)).count(), 0)
+        self.assertEqual(self.session.query(self.osmalchemy.relation).filter(
+            self.osmalchemy.relation.intersects_bbox(50.0, 7.3, 50.9, 8.0)).count(), 1)
+
 class OSMAlchemyModelTestsSQLite(OSMAlchemyModelTests, unittest.TestCase):
     """ Tests run with SQLite """
 
@@ -379,6 +630,20 @@ class OSMAlchemyModelTestsFlaskSQLAlchemy(OSMAlchemyModelTests, unittest.TestCas
         self.session.remove()
         OSMAlchemyModelTests.tearDown(self)
 
+    def test_refresh_workers_app_context(self):
+        # Background refresh uses the application of the Flask-SQLAlchemy instance
+        app = Flask("test")
+        db = FlaskSQLAlchemy(app)
+        osmalchemy = OSMAlchemy(db, prefix="refresh_", overpass=True, refresh_workers=1)
+        self.assertIs(osmalchemy._app, app)
+        osmalchemy.stop_refresh()
+
+        # Without an application, background refresh is refused
+        db = FlaskSQLAlchemy()
+        db.init_app(app)
+        with self.assertRaises(RuntimeError):
+            OSMAlchemy(db, prefix="refresh_", overpass=True, refresh_workers=1)
+
 # Make runnable as standalone script
 if __name__ == "__main__":
     unittest.main()
@@ -32,18 +32,33 @@
 import unittest
 
 # We want to profile test cases, and other imports
+import datetime
 import time
 import os
+import shutil
+import tempfile
+import threading
+from io import BytesIO, StringIO
+try:
+    import numpy
+except ImportError:
+    # non-fatal, NumPy is only needed for some tests
+    numpy = None
 
 # Helper libraries for different database engines
 from testing.mysqld import MysqldFactory
 from testing.postgresql import PostgresqlFactory
 
 # Module to be tested
+from benchmarks.synthetic import generate_osm
 from osmalchemy import OSMAlchemy
+from osmalchemy.bulk import _bulk_import_osm_xml
+from osmalchemy.online import (_import_elements_by_id, _overpass_query, _OverpassCache,
+                               _SingleFlight)
+from osmalchemy.util import _analyse_clause, _import_osm_xml
 
 # SQLAlchemy for working with model and data
-from sqlalchemy import create_engine
+from sqlalchemy import and_, create_engine, func, inspect, or_
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.orm import sessionmaker, scoped_session
 
@@ -51,6 +66,54 @@ from sqlalchemy.orm import sessionmaker, scoped_session
 Postgresql = PostgresqlFactory(cache_initialized_db=True)
 Mysqld = MysqldFactory(cache_initialized_db=True)
 
+# Small OSM document with all element types and repeated forward references
+TEST_XML = u"""<?xml version="1.0" encoding="UTF-8"?>
+<osm version="0.6" generator="test">
+ <bounds minlat="50.0" minlon="7.0" maxlat="51.0" maxlon="8.0"/>
+ <node id="1" lat="50.1" lon="7.1" version="2" visible="true">
+  <tag k="name" v="Eins"/>
+ </node>
+ <node id="2" lat="50.2" lon="7.2"/>
+ <way id="10" changeset="42">
+  <nd ref="1"/>
+  <nd ref="2"/>
+  <tag k="highway" v="residential"/>
+ </way>
+ <relation id="100">
+  <member type="way" ref="10" role="outer"/>
+  <member type="relation" ref="101" role=""/>
+  <tag k="name" v="Straße"/>
+ </relation>
+ <relation id="102">
+  <member type="relation" ref="101" role=""/>
+  <member type="relation" ref="101" role=""/>
+ </relation>
+</osm>
+"""
+
+class FakeOverpassAPI(object):
+    """ Stand-in for the Overpass API recording queries, returning TEST_XML by default """
+
+    def __init__(self, response=TEST_XML):
+        self.queries = []
+        self.response = response
+
+    def Get(self, query, responseformat="geojson"):
+        self.queries.append(query)
+        return self.response
+
+class BlockingOverpassAPI(FakeOverpassAPI):
+    """ Fake Overpass API only answering while the release event is set """
+
+    def __init__(self):
+        FakeOverpassAPI.__init__(self)
+        self.release = threading.Event()
+        self.release.set()
+
+    def Get(self, query, responseformat="geojson"):
+        self.release.wait(10)
+        return FakeOverpassAPI.Get(self, query, responseformat)
+
 # Dictionary to store profiling information about tests
 profile = {}
 
@@ -104,6 +167,25 @@ class OSMAlchemyUtilTests(object):
         # Ensure removal of everything from ORM
         self.session.remove()
 
+        self._check_schwarzrheindorf()
+
+    def test_import_osm_file_bulk(self):
+        # Construct path to test data file
+        path = os.path.join(self.datadir, "schwarzrheindorf.osm")
+
+        # Import data into model using Core
+        self.osmalchemy.import_osm_file(path, bulk=True)
+        # Ensure removal of everything from ORM
+        self.session.remove()
+
+        self._check_schwarzrheindorf()
+
+        # Ensure the ORM can still add elements afterwards
+        self.session.add(self.osmalchemy.node(51.0, 7.0, tags={u"foo": u"bar"}))
+        self.session.commit()
+
+    def _check_schwarzrheindorf(self):
+
         # Check number of elements
         nodes = self.session.query(self.osmalchemy.node).all()
         ways = self.session.query(self.osmalchemy.way).all()
@@ -169,6 +251,536 @@ class OSMAlchemyUtilTests(object):
         self.assertIn((wittestr, ""), buslinie.members)
         self.assertEqual(list(buslinie.members).index((wittestr, "")), 109)
 
+    def test_import_osm_xml(self):
+
+        # Import data into model
+        _import_osm_xml(self.osmalchemy, self.session, TEST_XML)
+        # Ensure removal of everything from ORM
+        self.session.remove()
+
+        # Check elements
+        node = self.session.query(self.osmalchemy.node).filter_by(id=1).one()
+        self.assertEqual(node.latitude, 50.1)
+        self.assertEqual(node.version, 2)
+        self.assertEqual(node.visible, True)
+        self.assertEqual(node.tags, {u"name": u"Eins"})
+        way = self.session.query(self.osmalchemy.way).filter_by(id=10).one()
+        self.assertEqual([n.id for n in way.nodes], [1, 2])
+        self.assertEqual(way.changeset, 42)
+        relation = self.session.query(self.osmalchemy.relation).filter_by(id=100).one()
+        self.assertEqual([(m.id, r) for m, r in relation.members], [(10, u"outer"), (101, u"")])
+        self.assertEqual(relation.tags[u"name"], u"Straße")
+
+    def test_import_osm_xml_batched(self):
+        self._check_import_osm_xml_batched(_import_osm_xml)
+
+    def test_import_osm_xml_batched_bulk(self):
+        self._check_import_osm_xml_batched(_bulk_import_osm_xml)
+
+    def _check_import_osm_xml_self_member(self, importer):
+        # Relation that is a member of itself
+        xml = u"""<?xml version="1.0" encoding="UTF-8"?>
+<osm version="0.6">
+ <relation id="200" version="1">
+  <member type="relation" ref="200" role="self"/>
+  <tag k="type" v="collection"/>
+ </relation>
+</osm>
+"""
+        importer(self.osmalchemy, self.session, xml)
+        self.session.remove()
+
+        # Check relation exists once and contains itself
+        relations = self.session.query(self.osmalchemy.relation).filter_by(id=200).all()
+        self.assertEqual(len(relations), 1)
+        self.assertEqual(relations[0].members, [(relations[0], u"self")])
+
+    def test_import_osm_xml_self_member(self):
+        self._check_import_osm_xml_self_member(_import_osm_xml)
+
+    def test_import_osm_xml_self_member_bulk(self):
+        self._check_import_osm_xml_self_member(_bulk_import_osm_xml)
+
+    def _check_import_osm_xml_json_tags(self, importer):
+        # Use a model storing tags as JSON as well
+        base = declarative_base(bind=self.engine)
+        osmalchemy = OSMAlchemy((self.engine, base, self.session), prefix="json_",
+                                json_tags=True)
+        base.metadata.create_all()
+
+        # Import data twice, so existing elements are updated
+        importer(osmalchemy, self.session, TEST_XML)
+        importer(osmalchemy, self.session, TEST_XML)
+        self.session.remove()
+
+        # Check tags in JSON column and tag tables, including those of stubs
+        for element in self.session.query(osmalchemy.element):
+            self.assertEqual(element.tags, dict(element._tags))
+        node = self.session.query(osmalchemy.node).filter_by(id=1).one()
+        self.assertEqual(node.tags_json, {u"name": u"Eins"})
+        relation = self.session.query(osmalchemy.relation).filter_by(id=100).one()
+        self.assertEqual(relation.tags_json, {u"name": u"Straße"})
+
+    def test_import_osm_xml_json_tags(self):
+        self._check_import_osm_xml_json_tags(_import_osm_xml)
+
+    def test_import_osm_xml_json_tags_bulk(self):
+        self._check_import_osm_xml_json_tags(_bulk_import_osm_xml)
+
+    def test_import_osm_file_deferred_indexes(self):
+        # Import data into model from a file object, without indexes
+        self.osmalchemy.import_osm_file(BytesIO(TEST_XML.encode("utf-8")), bulk=True,
+                                        defer_indexes=True)
+        # Ensure removal of everything from ORM
+        self.session.remove()
+
+        # Check data and that all indexes exist again
+        self.assertEqual(self.session.query(self.osmalchemy.element).count(), 6)
+        inspector = inspect(self.engine)
+        for cls in (self.osmalchemy.elements_tags, self.osmalchemy.ways_nodes,
+                    self.osmalchemy.relations_elements, self.osmalchemy.node):
+            names = set(index["name"] for index in inspector.get_indexes(cls.__tablename__))
+            for index in cls.__table__.indexes:
+                self.assertIn(index.name, names)
+
+    def test_query_bbox(self):
+        self._check_query_bbox(_import_osm_xml)
+
+    def test_query_bbox_bulk(self):
+        self._check_query_bbox(_bulk_import_osm_xml)
+
+    def _check_query_bbox(self, importer):
+        # Import data into model
+        importer(self.osmalchemy, self.session, TEST_XML)
+        # Ensure removal of everything from ORM
+        self.session.remove()
+
+        # Box around first node
+        nodes, ways, relations = self.osmalchemy.query_bbox(50.05, 7.05, 50.15, 7.15,
+                                                            types=("node", "way", "relation"))
+        self.assertEqual([n.id for n in nodes], [1])
+        self.assertEqual([w.id for w in ways], [10])
+        self.assertEqual([r.id for r in relations], [100])
+
+        # Box around both nodes, without relations
+        nodes, ways, relations = self.osmalchemy.query_bbox(50.0, 7.0, 50.3, 7.3)
+        self.assertEqual(sorted([n.id for n in nodes]), [1, 2])
+        self.assertEqual([w.id for w in ways], [10])
+        self.assertEqual(relations, [])
+
+        # Box crossing the antimeridian
+        nodes, ways, relations = self.osmalchemy.query_bbox(50.0, 7.15, 50.3, 7.05)
+        self.assertEqual([n.id for n in nodes], [2])
+
+        # Box without anything in it
+        nodes, ways, relations = self.osmalchemy.query_bbox(-10.0, -10.0, 10.0, 10.0)
+        self.assertEqual((nodes, ways, relations), ([], [], []))
+
+        # Boxes upside down are refused
+        with self.assertRaises(ValueError):
+            self.osmalchemy.query_bbox(51.0, 7.0, 50.0, 8.0)
+
+    def test_fixed_point_coordinates(self):
+        # Create a second model storing coordinates as integers
+        base = declarative_base(bind=self.engine)
+        osmalchemy = OSMAlchemy((self.engine, base, self.session), prefix="osmfp_",
+                                fixed_point=True)
+        base.metadata.create_all()
+
+        # Import data into model, once using each importer
+        _import_osm_xml(osmalchemy, self.session, TEST_XML)
+        _bulk_import_osm_xml(osmalchemy, self.session, TEST_XML)
+        # Ensure removal of everything from ORM
+        self.session.remove()
+
+        # Check stored values and their representation
+        node = self.session.query(osmalchemy.node).filter_by(latitude=50.1).one()
+        self.assertEqual((node.id, node.latitude, node.longitude), (1, 50.1, 7.1))
+        raw = self.engine.execute("SELECT latitude, longitude FROM osmfp_nodes "
+                                  "WHERE element_id = %d" % node.element_id).first()
+        self.assertEqual(tuple(raw), (501000000, 71000000))
+
+        # Check queries relying on coordinates
+        nodes, ways, relations = osmalchemy.query_bbox(50.05, 7.05, 50.15, 7.15)
+        self.assertEqual([n.id for n in nodes], [1])
+        way = self.session.query(osmalchemy.way).filter_by(id=10).one()
+        self.assertEqual((way.min_latitude, way.max_latitude), (50.1, 50.2))
+
+    def test_import_elements_by_id(self):
+        api = FakeOverpassAPI()
+
+        # Fetch elements of mixed types, with duplicates, in one query
+        _import_elements_by_id(self.osmalchemy, self.session, api,
+                               [("way", 10), ("node", 2), ("node", 1), ("relation", 100),
+                                ("node", 2)])
+        self.assertEqual(api.queries,
+                         ["(node(id:1,2);way(id:10);relation(id:100););(._;>;);"])
+
+        # Check response was imported
+        self.session.remove()
+        way = self.session.query(self.osmalchemy.way).filter_by(id=10).one()
+        self.assertEqual([n.id for n in way.nodes], [1, 2])
+
+        # Fetch in chunks, without recursion
+        api.queries = []
+        _import_elements_by_id(self.osmalchemy, self.session, api,
+                               [("node", 1), ("node", 2), ("way", 10)],
+                               recurse_down=False, chunk_size=2)
+        self.assertEqual(api.queries, ["(node(id:1,2););", "(way(id:10););"])
+        self.assertEqual(self.session.query(self.osmalchemy.node).count(), 2)
+
+        # Elements of any type are selected together, unknown types are refused
+        api.queries = []
+        _import_elements_by_id(self.osmalchemy, self.session, api, [("nwr", 5), ("node", 1)])
+        self.assertEqual(api.queries, ["(node(id:1);nwr(id:5););(._;>;);"])
+        with self.assertRaises(ValueError):
+            _import_elements_by_id(self.osmalchemy, self.session, api, [("area", 1)])
+
+    def test_load_way_geometries(self):
+        # Import data into model
+        _import_osm_xml(self.osmalchemy, self.session, TEST_XML)
+        self.session.remove()
+
+        # Load coordinates of way, leaving out unknown ways and other elements
+        geometries = self.osmalchemy.load_way_geometries([10, 11, 100])
+        self.assertEqual(list(geometries.keys()), [10])
+        self.assertEqual(list(geometries[10]), [50.1, 7.1, 50.2, 7.2])
+        self.assertEqual(geometries[10].typecode, "d")
+
+    @unittest.skipIf(numpy is None, "NumPy is not installed")
+    def test_load_way_geometries_numpy(self):
+        # Import data into model
+        _import_osm_xml(self.osmalchemy, self.session, TEST_XML)
+        self.session.remove()
+
+        # Load coordinates of way as NumPy array
+        geometries = self.osmalchemy.load_way_geometries([10], as_numpy=True)
+        self.assertEqual(geometries[10].shape, (2, 2))
+        self.assertEqual(geometries[10].tolist(), [[50.1, 7.1], [50.2, 7.2]])
+
+    def test_resolve_relation(self):
+        # Import data into model, with relation 101 containing relation 100 again
+        _import_osm_xml(self.osmalchemy, self.session, TEST_XML)
+        _import_osm_xml(self.osmalchemy, self.session, u"""<?xml version="1.0" encoding="UTF-8"?>
+<osm version="0.6" generator="test">
+ <relation id="101">
+  <member type="node" ref="2" role="stop"/>
+  <member type="relation" ref="100" role=""/>
+ </relation>
+</osm>
+""")
+        self.session.remove()
+
+        # Resolve whole cycle once, with members, node and way coordinates
+        relations, nodes, ways = self.osmalchemy.resolve_relation(100)
+        self.assertEqual(relations, {100: [("way", 10, "outer"), ("relation", 101, "")],
+                                     101: [("node", 2, "stop"), ("relation", 100, "")]})
+        self.assertEqual(nodes, {2: (50.2, 7.2)})
+        self.assertEqual(list(ways.keys()), [10])
+        self.assertEqual(list(ways[10]), [50.1, 7.1, 50.2, 7.2])
+
+        # Resolve only the relation itself
+        relations, nodes, ways = self.osmalchemy.resolve_relation(100, depth=1)
+        self.assertEqual(relations, {100: [("way", 10, "outer"), ("relation", 101, "")]})
+        self.assertEqual(nodes, {})
+        self.assertEqual(list(ways.keys()), [10])
+
+        # Unknown relations resolve to nothing
+        self.assertEqual(self.osmalchemy.resolve_relation(10), ({}, {}, {}))
+
+    def test_overpass_query(self):
+        node, way, tag = self.osmalchemy.node, self.osmalchemy.way, self.osmalchemy.tag
+
+        def _query(model, type, *criteria):
+            # Compile the where clause of a query on the model
+            query = self.session.query(model).join(
+                self.osmalchemy.elements_tags,
+                self.osmalchemy.elements_tags.element_id == model.element_id).join(
+                    tag).filter(*criteria)
+            return _overpass_query(_analyse_clause(query.whereclause, model, tag), type)
+
+        # Latitude and longitude ranges are folded into a bounding box
+        self.assertEqual(_query(node, "node", node.latitude >= 50.0, node.latitude < 51.0,
+                                node.longitude > 7.0, node.longitude <= 8.0, node.longitude <= 9.0),
+                         "(node(50.0000000,7.0000000,51.0000000,8.0000000););")
+        # Alternatives are united, tags are filtered and children recursed into
+        self.assertEqual(_query(way, "way", or_(way.id == 10, way.id == 11),
+                                tag.key == u"highway", tag.value != u"foot\"way"),
+                         '(way(id:10)["highway"!="foot\\"way"];way(id:11)["highway"!="foot\\"way"];);'
+                         '(._;>;);')
+        # Bounds of ways select ways intersecting a bounding box
+        self.assertEqual(_query(way, "way", way.intersects_bbox(50.0, 7.0, 51.0, 8.0)),
+                         "(way(50.0000000,7.0000000,51.0000000,8.0000000););(._;>;);")
+        # Lists, ranges and patterns
+        self.assertEqual(_query(node, "node", node.id.in_([2, 1]), node.latitude.between(50.0, 51.0)),
+                         "(node(id:1,2)(50.0000000,-180.0000000,51.0000000,180.0000000););")
+        self.assertEqual(_query(way, "way", way.id == 10, tag.key == u"name",
+                                tag.value.in_([u"A.", u"B"])),
+                         '(way(id:10)["name"~"^(A\\\\.|B)$"];);(._;>;);')
+        self.assertEqual(_query(way, "way", way.id == 10, tag.key == u"name",
+                                tag.value.ilike(u"%str._")),
+                         '(way(id:10)["name"~"^.*str\\\\..$",i];);(._;>;);')
+        # Tags of elements
+        self.assertEqual(_query(node, "node", node.id == 1, node.has_tag(u"name"),
+                                node.has_tag(u"amenity", u"pub")),
+                         '(node(id:1)["name"]["amenity"="pub"];);')
+        self.assertEqual(_query(node, "node", node.id.in_([])), None)
+
+        # Open ranges, unsupported clauses and contradictions give no query
+        self.assertIsNone(_query(node, "node", node.latitude >= 50.0, node.version == 2))
+        self.assertIsNone(_query(node, "node", tag.key == u"highway"))
+        self.assertIsNone(_query(node, "node", or_(node.id == 1, node.latitude >= 50.0)))
+        self.assertIsNone(_query(node, "node", or_(node.id == 1, func.lower(node.user) == u"x")))
+        self.assertEqual(_query(node, "node", node.id.in_([1, 2]),
+                                or_(node.id == 1, func.lower(node.user) == u"x")),
+                         "(node(id:1,2););")
+        self.assertIsNone(_query(node, "node", and_(node.id == 1, node.id == 2)))
+
+    def test_online_query(self):
+        # Create a model with online functionality, using a fake API
+        base = declarative_base(bind=self.engine)
+        osmalchemy = OSMAlchemy((self.engine, base, self.session), prefix="online_",
+                                overpass=True)
+        base.metadata.create_all()
+        api = osmalchemy._overpass = FakeOverpassAPI()
+
+        # Querying the way fetches it with its nodes first
+        way = self.session.query(osmalchemy.way).filter_by(id=10).one()
+        self.assertEqual([n.id for n in way.nodes], [1, 2])
+        self.assertEqual(api.queries, ["(way(id:10););(._;>;);"])
+
+        # Queries without limited set of elements are not run online
+        self.session.query(osmalchemy.node).filter(osmalchemy.node.latitude > 50.0).all()
+        self.assertEqual(len(api.queries), 1)
+
+        # Fresh elements are not fetched again, missing ones are fetched by id
+        self.session.query(osmalchemy.way).filter_by(id=10).one()
+        self.assertEqual(len(api.queries), 1)
+        self.session.query(osmalchemy.node).filter(
+            or_(osmalchemy.node.id == 1, osmalchemy.node.id == 3)).all()
+        self.assertEqual(api.queries[1:], ["(node(id:3););(._;>;);"])
+
+        # Elements not found online are not asked for again
+        self.assertEqual(self.session.query(osmalchemy.node).filter_by(id=3).all(), [])
+        self.assertEqual(len(api.queries), 2)
+
+        # Expired elements are fetched by id and marked as updated
+        self.session.execute(osmalchemy.element.__table__.update().where(
+            osmalchemy.element.__table__.c.id == 10).values(
+                osmalchemy_updated=datetime.datetime(2000, 1, 1)))
+        self.session.commit()
+        self.session.query(osmalchemy.way).filter_by(id=10).one()
+        self.session.query(osmalchemy.way).filter_by(id=10).one()
+        self.assertEqual(api.queries[2:], ["(way(id:10););(._;>;);"])
+
+        # Areas with some elements are not fetched again
+        bbox = and_(osmalchemy.node.latitude >= 50.0, osmalchemy.node.latitude <= 51.0,
+                    osmalchemy.node.longitude >= 7.0, osmalchemy.node.longitude <= 8.0)
+        self.session.query(osmalchemy.node).filter(bbox).all()
+        self.assertEqual(len(api.queries), 3)
+
+        # Areas without elements are fetched as a whole
+        bbox = and_(osmalchemy.node.latitude >= 10.0, osmalchemy.node.latitude <= 11.0,
+                    osmalchemy.node.longitude >= 10.0, osmalchemy.node.longitude <= 11.0)
+        self.session.query(osmalchemy.node).filter(bbox).all()
+        self.assertEqual(api.queries[3:],
+                         ["(node(10.0000000,10.0000000,11.0000000,11.0000000););"])
+
+        # Empty areas are not asked for again
+        self.session.query(osmalchemy.node).filter(bbox).all()
+        self.assertEqual(len(api.queries), 4)
+
+        # Sessions can opt out of going online
+        session = sessionmaker(bind=self.engine, info={"osmalchemy_online": False})()
+        session.query(osmalchemy.node).filter_by(id=4).all()
+        self.assertEqual(len(api.queries), 4)
+        session.close()
+
+        # Queries for columns of elements go online as well
+        self.session.query(osmalchemy.node.latitude).filter_by(id=4).all()
+        self.assertEqual(api.queries[4:], ["(node(id:4););(._;>;);"])
+
+        # Limits and ordering do not hide fresh elements from planning
+        node = osmalchemy.node
+        self.session.query(node).filter(node.id.in_([1, 2])).order_by(node.id).first()
+        self.session.query(node.id, func.count()).filter(node.id.in_([1, 2])).group_by(
+            node.id).order_by(func.count()).limit(1).all()
+        self.assertEqual(len(api.queries), 5)
+
+        # Elements filtered out by the query are not remembered as not found online
+        self.session.query(node).filter(node.id.in_([1, 5]), node.latitude > 60.0).all()
+        self.assertEqual(len(api.queries), 6)
+        self.session.execute(osmalchemy.element.__table__.update().where(
+            osmalchemy.element.__table__.c.id == 1).values(
+                osmalchemy_updated=datetime.datetime(2000, 1, 1)))
+        self.session.commit()
+        self.session.query(node).filter_by(id=1).all()
+        self.session.query(node).filter_by(id=5).all()
+        self.assertEqual(api.queries[6:], ["(node(id:1););(._;>;);"])
+
+        # Elements of any type are fetched by id as such, fresh ones are not
+        element = osmalchemy.element
+        self.assertEqual(self.session.query(element).filter(element.id == 5).all(), [])
+        self.session.query(element).filter(element.id == 5).all()
+        self.assertEqual([e.type for e in self.session.query(element).filter(
+            element.id == 10)], [u"way"])
+        self.assertEqual(api.queries[7:], ["(nwr(id:5););(._;>;);"])
+
+    def test_online_query_background_refresh(self):
+        # Background threads need a database shared by all connections
+        directory = tempfile.mkdtemp()
+        if self.engine.url.drivername == "sqlite":
+            engine = create_engine("sqlite:///" + os.path.join(directory, "online.db"))
+        else:
+            engine = self.engine
+        base = declarative_base(bind=engine)
+        session = scoped_session(sessionmaker(bind=engine))
+        osmalchemy = OSMAlchemy((engine, base, session), prefix="refresh_", overpass=True,
+                                refresh_workers=1)
+        try:
+            base.metadata.create_all()
+            api = osmalchemy._overpass = BlockingOverpassAPI()
+
+            # Missing elements are fetched before running the query
+            session.query(osmalchemy.way).filter_by(id=10).one()
+            self.assertEqual(api.queries, ["(way(id:10););(._;>;);"])
+
+            # Expired elements are served while the refresh is waiting for the API
+            session.execute(osmalchemy.element.__table__.update().where(
+                osmalchemy.element.__table__.c.id == 10).values(
+                    osmalchemy_updated=datetime.datetime(2000, 1, 1)))
+            session.commit()
+            api.release.clear()
+            way = session.query(osmalchemy.way).filter_by(id=10).one()
+            self.assertEqual(way.osmalchemy_updated, datetime.datetime(2000, 1, 1))
+            session.remove()
+
+            # Refresh finishes in the background
+            api.release.set()
+            osmalchemy._refresh_queue.join()
+            self.assertEqual(api.queries[1:], ["(way(id:10););(._;>;);"])
+            way = session.query(osmalchemy.way).filter_by(id=10).one()
+            self.assertGreater(way.osmalchemy_updated, datetime.datetime(2000, 1, 1))
+            session.remove()
+
+            # Once stopped, expired elements are refreshed before running the query
+            osmalchemy.stop_refresh()
+            self.assertFalse([thread for thread in threading.enumerate()
+                              if thread.name.startswith("osmalchemy-refresh-")])
+            session.execute(osmalchemy.element.__table__.update().where(
+                osmalchemy.element.__table__.c.id == 10).values(
+                    osmalchemy_updated=datetime.datetime(2000, 1, 1)))
+            session.commit()
+            way = session.query(osmalchemy.way).filter_by(id=10).one()
+            self.assertGreater(way.osmalchemy_updated, datetime.datetime(2000, 1, 1))
+            self.assertEqual(len(api.queries), 3)
+        finally:
+            osmalchemy.stop_refresh()
+            session.remove()
+            if engine is not self.engine:
+                engine.dispose()
+            shutil.rmtree(directory)
+
+    def test_overpass_cache(self):
+        api = FakeOverpassAPI()
+        directory = tempfile.mkdtemp()
+        try:
+            cache = _OverpassCache(api, directory, ttl=60)
+
+            # Repeated and reformatted queries are answered from the cache
+            self.assertEqual(cache.Get("node(id:1);"), TEST_XML)
+            self.assertEqual(cache.Get(" node(id:1);\n"), TEST_XML)
+            self.assertEqual(api.queries, ["node(id:1);"])
+
+            # Another process using the same directory shares responses
+            self.assertEqual(_OverpassCache(api, directory).Get("node(id:1);"), TEST_XML)
+            self.assertEqual(len(api.queries), 1)
+
+            # Expired responses are fetched again
+            path = os.path.join(directory, os.listdir(directory)[0])
+            os.utime(path, (time.time(), time.time() - 120))
+            cache.Get("node(id:1);")
+            self.assertEqual(len(api.queries), 2)
+
+            # Least recently used responses are evicted
+            cache.max_size = os.path.getsize(path) + 1
+            os.utime(path, (time.time() - 60, time.time()))
+            cache.Get("node(id:2);")
+            self.assertEqual(len(os.listdir(directory)), 1)
+            cache.Get("node(id:2);")
+            self.assertEqual(len(api.queries), 3)
+
+            # Responses without elements are not stored
+            api.response = u'<?xml version="1.0"?><osm version="0.6"></osm>'
+            cache.Get("node(id:3);")
+            cache.Get("node(id:3);")
+            self.assertEqual(len(api.queries), 5)
+            api.response = TEST_XML
+
+            # Stored responses can be imported again
+            cache.replay(self.osmalchemy, self.session)
+            way = self.session.query(self.osmalchemy.way).filter_by(id=10).one()
+            self.assertEqual([n.id for n in way.nodes], [1, 2])
+        finally:
+            shutil.rmtree(directory)
+
+    def test_single_flight(self):
+        directory = tempfile.mkdtemp()
+        try:
+            def _fetch(flights, events):
+                with flights.flight("node(id:1);"):
+                    events.append("start")
+                    time.sleep(0.05)
+                    events.append("end")
+
+            # Threads sharing locks, and separate locks sharing a directory like processes
+            flights = _SingleFlight()
+            for pair in ((flights, flights),
+                         (_SingleFlight(directory), _SingleFlight(directory))):
+                events = []
+                threads = [threading.Thread(target=_fetch, args=(f, events)) for f in pair]
+                for thread in threads:
+                    thread.start()
+                for thread in threads:
+                    thread.join()
+
+                # Flights for the same key never overlap
+                self.assertEqual(events, ["start", "end", "start", "end"])
+
+            # Unused locks are removed
+            self.assertEqual(flights._locks, {})
+        finally:
+            shutil.rmtree(directory)
+
+    def _check_import_osm_xml_batched(self, importer):
+        for batch_size in (1, 2, None):
+            # Import data into model, twice to also update existing elements
+            importer(self.osmalchemy, self.session, TEST_XML, batch_size)
+            importer(self.osmalchemy, self.session, TEST_XML, batch_size)
+            # Ensure removal of everything from ORM
+            self.session.remove()
+
+            # Check that no element was duplicated
+            self.assertEqual(self.session.query(self.osmalchemy.node).count(), 2)
+            self.assertEqual(self.session.query(self.osmalchemy.way).count(), 1)
+            self.assertEqual(self.session.query(self.osmalchemy.relation).count(), 3)
+
+            # Check repeated stub member
+            relation = self.session.query(self.osmalchemy.relation).filter_by(id=102).one()
+            stub = self.session.query(self.osmalchemy.relation).filter_by(id=101).one()
+            self.assertEqual(list(relation.members), [(stub, u""), (stub, u"")])
+            way = self.session.query(self.osmalchemy.way).filter_by(id=10).one()
+            self.assertEqual([n.id for n in way.nodes], [1, 2])
+            self.assertEqual(way.tags, {u"highway": u"residential"})
+
+            # Check bounds of way and relation with the way and a stub member
+            relation = self.session.query(self.osmalchemy.relation).filter_by(id=100).one()
+            for element in (way, relation):
+                self.assertEqual((element.min_latitude, element.max_latitude,
+                                  element.min_longitude, element.max_longitude),
+                                 (50.1, 50.2, 7.1, 7.2))
+            self.session.remove()
+
 class OSMAlchemyUtilTestsSQLite(OSMAlchemyUtilTests, unittest.TestCase):
     """ Tests run with SQLite """
 
@@ -203,6 +815,24 @@ class OSMAlchemyUtilTestsMySQL(OSMAlchemyUtilTests, unittest.TestCase):
         self.mysql.stop()
         OSMAlchemyUtilTests.tearDown(self)
 
+class SyntheticDataTests(unittest.TestCase):
+    """ Tests of the synthetic data generator of the benchmarks """
+
+    def _generate(self, **params):
+        out = StringIO()
+        generate_osm(out, nodes=100, ways=10, relations=3, **params)
+        return out.getvalue()
+
+    def test_generate_osm_deterministic(self):
+        # Same parameters give the same document, another seed another one
+        self.assertEqual(self._generate(), self._generate())
+        self.assertNotEqual(self._generate(), self._generate(seed=23))
+
+    def test_generate_osm_without_tags(self):
+        data = self._generate(tags=0)
+        self.assertEqual(data.count(u"<way "), 10)
+        self.assertNotIn(u'<tag k="highway"', data)
+
 # Make runnable as standalone script
 if __name__ == "__main__":
     unittest.main()